@@ -1,38 +1,195 @@
 # agent.py
 
 import asyncio
-import yaml
 from core.loop import AgentLoop
 from core.session import MultiMCP
-from core.context import MemoryItem, AgentContext
+from core.context import AgentContext
+from core.config import load_profile, get_mcp_servers
 import datetime
-from pathlib import Path
-import json
+import functools
+import threading
 import re
 from modules.guardrail import check_query, check_result
-from modules.conversation_indexer import index_conversation
+from modules.historical_check import check_historical_conversations
+from modules.model_manager import get_model_manager
+from modules.tools import LRUCache
+
+# Tag and payload of a loop result, e.g. "FINAL_ANSWER: 42" -> ("FINAL_ANSWER", "42")
+_ANSWER_RE = re.compile(r"(FINAL_ANSWER|FURTHER_PROCESSING_REQUIRED):\s*(.*)", re.S)
 
 def log(stage: str, msg: str):
     """Simple timestamped console logger."""
     now = datetime.datetime.now().strftime("%H:%M:%S")
     print(f"[{now}] [{stage}] {msg}")
 
+@functools.cache
+def _indexer_module():
+    """Import the FAISS-backed conversation indexer on first use (it is warmed during MCP startup)."""
+    from modules import conversation_indexer
+    return conversation_indexer
+
+async def _ainput(prompt: str) -> str:
+    """
+    Read a line from stdin without blocking the event loop.
+
+    Uses a daemon thread rather than the default executor so a pending prompt
+    never holds up interpreter shutdown.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def _resolve(line, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(line)
+
+    def _read():
+        try:
+            line = input(prompt)
+        except Exception as e:  # EOFError on closed stdin
+            loop.call_soon_threadsafe(_resolve, None, e)
+        else:
+            loop.call_soon_threadsafe(_resolve, line, None)
+
+    threading.Thread(target=_read, daemon=True).start()
+    return await future
+
+def _result_text(result) -> str:
+    """User-visible text of an agent result; only unknown shapes are stringified whole."""
+    if isinstance(result, str):
+        return result
+    if isinstance(result, dict):
+        text = result.get("result") or result.get("answer")
+        if text is not None:
+            return text if isinstance(text, str) else str(text)
+    return str(result)
+
+def _extract_tool_calls(items) -> list:
+    """Summarize tool_output memory items for indexing."""
+    record = _indexer_module().ToolCallRecord
+    return [
+        record(i.tool_name, i.tool_args or {}, i.success or False)
+        for i in items
+        if i.tool_name
+    ]
+
+def _emit_final(label: str, text: str):
+    """Guardrail-check the final answer and print it - the only place answers reach the user."""
+    result_check = check_result(text)
+    if result_check.warnings:
+        log("guardrail", f"⚠️  Final answer warnings: {', '.join(result_check.warnings)}")
+    print(f"\n💡 {label}: {result_check.sanitized_content}")
+
+# Exact-match tier ahead of the semantic cache: normalized query -> answer, for repeats
+# within this process (no embedding call). Only touched from the event loop thread.
+_exact_cache = LRUCache(256)
+
+def _norm_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+def _exact_get(query: str):
+    return _exact_cache.get(_norm_query(query))
+
+def _exact_put(query: str, answer: str):
+    if not answer or any(m in answer.lower() for m in _indexer_module().UNCACHEABLE_MARKERS):
+        return
+    _exact_cache.put(_norm_query(query), answer)
+
+# Background indexing tasks, awaited on shutdown so no conversation is lost
+_pending_index_tasks = set()
+
+async def _index_in_background(**kwargs):
+    try:
+        await _indexer_module().aindex_conversation(**kwargs)
+        log("agent", "✅ Conversation indexed for semantic search")
+    except Exception as e:
+        log("agent", f"⚠️  Failed to index conversation: {e}")
+
+def _finalize_answer(context, user_query: str, answer: str, query_embedding=None,
+                     label: str = "Final Answer", include_tool_calls: bool = True,
+                     cacheable: bool = True, exact_cache: bool = False):
+    """
+    Print the guardrailed answer, then index the original one in the background.
+
+    Args:
+        context: AgentContext of the finished turn
+        user_query: Original (unsanitized) user query
+        answer: Original (unsanitized) answer text
+        query_embedding: Precomputed embedding of user_query, if available
+        label: Prefix for the printed answer
+        include_tool_calls: Whether to record the session's tool calls in the index
+        cacheable: False for failed runs - the answer is shown but never cached or indexed,
+            so the semantic cache can't serve an error reply to later queries
+        exact_cache: Whether to remember the answer in the exact-match tier (only read
+            when memory.enable_semantic_cache is on)
+    """
+    _emit_final(label, answer)
+    if not cacheable:
+        log("agent", "⏭️ Run ended in an error - not caching or indexing this answer")
+        return
+    if exact_cache:
+        _exact_put(user_query, answer)
+
+    # Index conversation with original (unsanitized) answer
+    try:
+        tool_calls = _extract_tool_calls(context.memory.get_tool_outputs()) if include_tool_calls else None
+    except Exception as e:
+        log("agent", f"⚠️  Failed to index conversation: {e}")
+        return
+    task = asyncio.create_task(_index_in_background(
+        session_id=context.session_id,
+        user_query=user_query,
+        final_answer=answer,  # Store original, not sanitized
+        tool_calls=tool_calls or None,
+        timestamp=datetime.datetime.now().timestamp(),
+        query_embedding=query_embedding,
+        profile=context.agent_profile.id,
+    ))
+    _pending_index_tasks.add(task)
+    task.add_done_callback(_pending_index_tasks.discard)
+
+async def _check_history_when_embedded(user_input: str, multi_mcp, embedding_task) -> dict:
+    """Historical pre-check, started before the query embedding is ready (its similarity gate awaits it)."""
+    return await check_historical_conversations(user_input, multi_mcp, query_embedding=await embedding_task)
+
+async def _drain_index_tasks():
+    if _pending_index_tasks:
+        log("agent", f"⏳ Waiting for {len(_pending_index_tasks)} pending indexing task(s)...")
+        await asyncio.gather(*_pending_index_tasks, return_exceptions=True)
+
 async def main():
     print("🧠 Cortex-R Agent Ready")
     current_session = None
 
-    with open("config/profiles.yaml", "r") as f:
-        profile = yaml.safe_load(f)
-        mcp_servers_list = profile.get("mcp_servers", [])
-        mcp_servers = {server["id"]: server for server in mcp_servers_list}
+    profile = load_profile()
+    mcp_servers = get_mcp_servers()
+    memory_config = profile.get("memory", {})
+    semantic_cache_enabled = memory_config.get("enable_semantic_cache", False)
+    semantic_cache_threshold = memory_config.get("semantic_cache_threshold", 0.92)
+    semantic_cache_ttl_days = memory_config.get("semantic_cache_ttl_days")
+    profile_id = profile.get("agent", {}).get("id")
+
+    # Dev aid: asyncio debug mode logs any callback that blocks the loop for too long
+    slow_callback_ms = profile.get("debug", {}).get("slow_callback_ms", 0)
+    if slow_callback_ms:
+        loop = asyncio.get_running_loop()
+        loop.set_debug(True)
+        loop.slow_callback_duration = slow_callback_ms / 1000
+        log("agent", f"🐢 Logging event-loop callbacks slower than {slow_callback_ms}ms")
 
     multi_mcp = MultiMCP(server_configs=list(mcp_servers.values()))
+    # Load the FAISS index while the MCP servers bootstrap
+    indexer_warmup = asyncio.create_task(asyncio.to_thread(lambda: _indexer_module().get_indexer()))
     await multi_mcp.initialize()
+    await indexer_warmup
     print("&&&&", multi_mcp)
 
     try:
         while True:
-            user_input = input("🧑 What do you want to solve today? → ")
+            user_input = await _ainput("🧑 What do you want to solve today? → ")
             if user_input.lower() == 'exit':
                 break
             if user_input.lower() == 'new':
@@ -56,184 +213,124 @@ async def main():
                 log("guardrail", f"⚠️  Query warnings: {', '.join(query_check.warnings)}")
                 user_input = query_check.sanitized_content
 
+            # Exact-match cache: repeats of a query in this session need no embedding at all
+            if semantic_cache_enabled:
+                cached_answer = _exact_get(original_user_input)
+                if cached_answer is not None:
+                    log("agent", "⚡ Exact cache hit - skipping embedding, historical check and tool loop")
+                    _emit_final("Final Answer", cached_answer)
+                    continue
+
+            # One embedding per turn, shared by the semantic cache, the historical gate and indexing.
+            # Only the semantic cache needs it up front; otherwise it overlaps context setup.
+            embedding_task = asyncio.ensure_future(_indexer_module().get_query_embedding_async(original_user_input))
+
+            # Semantic cache: serve near-duplicate queries straight from the conversation index
+            if semantic_cache_enabled:
+                query_embedding = await embedding_task
+                # Off the event loop: get_indexer() may still be loading, and the lookup may
+                # backfill the query index (blocking HTTP)
+                cached = await asyncio.to_thread(lambda: _indexer_module().get_indexer().lookup_answer(
+                    query_embedding,
+                    threshold=semantic_cache_threshold,
+                    profile=profile_id,
+                    max_age_days=semantic_cache_ttl_days,
+                ))
+                if cached:
+                    log("agent", f"⚡ Semantic cache hit (similarity {cached['similarity']:.3f}) - skipping historical check and tool loop")
+                    _emit_final("Final Answer", cached["final_answer"])
+                    _exact_put(original_user_input, cached["final_answer"])
+                    continue
+
+            context = None
             while True:
-                # Pre-check layer: Check if answer is in historical conversations
-                from modules.historical_check import check_historical_conversations
-                historical_check = await check_historical_conversations(user_input, multi_mcp)
-                
-                if historical_check.get("can_answer", False):
-                    # Case 1: Answer found in history - return directly
-                    answer = historical_check["answer"]
-                    log("agent", "✅ Direct answer from historical conversations - skipping tool loop")
-                    
-                    # Extract final answer text (no guardrail checks here)
-                    final_answer_text = answer.split('FINAL_ANSWER:')[1].strip() if "FINAL_ANSWER:" in answer else answer
-                    original_answer = final_answer_text
-                    
-                    # Index this conversation with original (unsanitized) answer
-                    context = AgentContext(
-                        user_input=user_input,
-                        session_id=current_session,
-                        dispatcher=multi_mcp,
-                        mcp_server_descriptions=mcp_servers,
+                if context is None:
+                    # Pre-check layer: Check if answer is in historical conversations.
+                    # Context setup is independent of it, so run it alongside; the query embedding
+                    # keeps computing meanwhile and is awaited only by the check's similarity gate.
+                    historical_check, context = await asyncio.gather(
+                        _check_history_when_embedded(user_input, multi_mcp, embedding_task),
+                        asyncio.to_thread(
+                            AgentContext,
+                            user_input=user_input,
+                            session_id=current_session,
+                            dispatcher=multi_mcp,
+                            mcp_server_descriptions=mcp_servers,
+                        ),
                     )
+                    query_embedding = embedding_task.result()  # Done: the historical check awaited it
                     if not current_session:
                         current_session = context.session_id
+                
+                    if historical_check.get("can_answer", False):
+                        # Case 1: Answer found in history - return directly
+                        answer = historical_check["answer"]
+                        log("agent", "✅ Direct answer from historical conversations - skipping tool loop")
                     
-                    try:
-                        index_conversation(
-                            session_id=context.session_id,
-                            user_query=original_user_input,
-                            final_answer=original_answer,  # Store original, not sanitized
-                            tool_calls=None
-                        )
-                        log("agent", "✅ Conversation indexed for semantic search")
-                    except Exception as e:
-                        log("agent", f"⚠️  Failed to index conversation: {e}")
-                    
-                    # Guardrail check ONLY at final print statement
-                    result_check = check_result(final_answer_text)
-                    sanitized_answer = result_check.sanitized_content
-                    if result_check.warnings:
-                        log("guardrail", f"⚠️  Final answer warnings: {', '.join(result_check.warnings)}")
-                    print(f"\n💡 Final Answer: {sanitized_answer}")
-                    break
+                        # Extract final answer text (no guardrail checks here)
+                        match = _ANSWER_RE.search(answer)
+                        final_answer_text = match.group(2).strip() if match else answer
+                        _finalize_answer(context, original_user_input, final_answer_text, query_embedding,
+                                         include_tool_calls=False, exact_cache=semantic_cache_enabled)
+                        break
                 
-                # Case 2 or 3: Answer not in history - proceed with full agent loop
-                context = AgentContext(
-                    user_input=user_input,
-                    session_id=current_session,
-                    dispatcher=multi_mcp,
-                    mcp_server_descriptions=mcp_servers,
-                )
+                    # Case 2 or 3: Answer not in history - proceed with full agent loop
+                    # If has relevant context, store it to pass to perception layer
+                    historical_context = None
+                    if historical_check.get("has_context", False):
+                        historical_context = historical_check.get("context", "")
+                        log("agent", "📚 Proceeding to tool loop with historical context (will be sent to perception)")
+                    else:
+                        log("agent", "🆕 Proceeding to tool loop with fresh approach (no relevant history)")
                 
-                # If has relevant context, store it to pass to perception layer
-                historical_context = None
-                if historical_check.get("has_context", False):
-                    historical_context = historical_check.get("context", "")
-                    log("agent", "📚 Proceeding to tool loop with historical context (will be sent to perception)")
+                    # Store historical context in context for perception to use
+                    context.historical_context = historical_context
                 else:
-                    log("agent", "🆕 Proceeding to tool loop with fresh approach (no relevant history)")
-                
-                # Store historical context in context for perception to use
-                context.historical_context = historical_context
+                    # FURTHER_PROCESSING_REQUIRED: keep session memory and history from the first pass
+                    context.user_input = user_input
+                    context.user_input_override = None
+                    context.final_answer = None
                 
                 agent = AgentLoop(context)
-                if not current_session:
-                    current_session = context.session_id
 
                 result = await agent.run()
 
                 if isinstance(result, dict):
-                    answer = result["result"]
-                    if "FINAL_ANSWER:" in answer:
+                    answer = _result_text(result)
+                    failed = result.get("status") == "error"
+                    match = _ANSWER_RE.search(answer)
+                    tag = match.group(1) if match else None
+                    if tag == "FINAL_ANSWER":
                         # Extract original answer (no guardrail checks here)
-                        final_answer_text = answer.split('FINAL_ANSWER:')[1].strip()
-                        original_answer = final_answer_text
-                        
-                        # Index conversation with original (unsanitized) answer
-                        try:
-                            memory_items = context.memory.get_session_items()
-                            tool_calls = []
-                            for item in memory_items:
-                                if item.type == "tool_output" and item.tool_name:
-                                    tool_calls.append({
-                                        "tool_name": item.tool_name,
-                                        "tool_args": item.tool_args or {},
-                                        "success": item.success or False
-                                    })
-                            
-                            index_conversation(
-                                session_id=context.session_id,
-                                user_query=original_user_input,  # Use original query, not sanitized
-                                final_answer=original_answer,  # Store original, not sanitized
-                                tool_calls=tool_calls if tool_calls else None
-                            )
-                            log("agent", "✅ Conversation indexed for semantic search")
-                        except Exception as e:
-                            log("agent", f"⚠️  Failed to index conversation: {e}")
-                        
-                        # Guardrail check ONLY at final print statement
-                        result_check = check_result(final_answer_text)
-                        sanitized_answer = result_check.sanitized_content
-                        if result_check.warnings:
-                            log("guardrail", f"⚠️  Final answer warnings: {', '.join(result_check.warnings)}")
-                        print(f"\n💡 Final Answer: {sanitized_answer}")
+                        final_answer_text = match.group(2).strip()
+                        _finalize_answer(context, original_user_input, final_answer_text, query_embedding,
+                                         cacheable=not failed, exact_cache=semantic_cache_enabled)
                         break
-                    elif "FURTHER_PROCESSING_REQUIRED:" in answer:
-                        user_input = answer.split("FURTHER_PROCESSING_REQUIRED:")[1].strip()
+                    elif tag == "FURTHER_PROCESSING_REQUIRED":
+                        user_input = match.group(2).strip()
                         print(f"\n🔁 Further Processing Required: {user_input}")
                         continue  # 🧠 Re-run agent with updated input
                     else:
-                        # Store original answer for memory/indexing (no guardrail checks here)
-                        original_answer = answer
-                        
-                        # Index conversation with original (unsanitized) answer
-                        try:
-                            memory_items = context.memory.get_session_items()
-                            tool_calls = []
-                            for item in memory_items:
-                                if item.type == "tool_output" and item.tool_name:
-                                    tool_calls.append({
-                                        "tool_name": item.tool_name,
-                                        "tool_args": item.tool_args or {},
-                                        "success": item.success or False
-                                    })
-                            index_conversation(
-                                session_id=context.session_id,
-                                user_query=original_user_input,
-                                final_answer=original_answer,  # Store original, not sanitized
-                                tool_calls=tool_calls if tool_calls else None
-                            )
-                            log("agent", "✅ Conversation indexed for semantic search")
-                        except Exception as e:
-                            log("agent", f"⚠️  Failed to index conversation: {e}")
-                        
-                        # Guardrail check ONLY at final print statement
-                        result_check = check_result(answer)
-                        sanitized_answer = result_check.sanitized_content
-                        if result_check.warnings:
-                            log("guardrail", f"⚠️  Final answer warnings: {', '.join(result_check.warnings)}")
-                        print(f"\n💡 Final Answer (raw): {sanitized_answer}")
+                        _finalize_answer(context, original_user_input, answer, query_embedding,
+                                         label="Final Answer (raw)", cacheable=not failed,
+                                         exact_cache=semantic_cache_enabled)
                         break
                 else:
-                    # Store original result for memory/indexing (no guardrail checks here)
-                    result_str = str(result)
-                    original_result = result_str
-                    
-                    # Index conversation with original (unsanitized) result
-                    try:
-                        memory_items = context.memory.get_session_items()
-                        tool_calls = []
-                        for item in memory_items:
-                            if item.type == "tool_output" and item.tool_name:
-                                tool_calls.append({
-                                    "tool_name": item.tool_name,
-                                    "tool_args": item.tool_args or {},
-                                    "success": item.success or False
-                                })
-                        index_conversation(
-                            session_id=context.session_id,
-                            user_query=original_user_input,
-                            final_answer=original_result,  # Store original, not sanitized
-                            tool_calls=tool_calls if tool_calls else None
-                        )
-                        log("agent", "✅ Conversation indexed for semantic search")
-                    except Exception as e:
-                        log("agent", f"⚠️  Failed to index conversation: {e}")
-                    
-                    # Guardrail check ONLY at final print statement
-                    result_check = check_result(result_str)
-                    sanitized_result = result_check.sanitized_content
-                    if result_check.warnings:
-                        log("guardrail", f"⚠️  Final answer warnings: {', '.join(result_check.warnings)}")
-                    print(f"\n💡 Final Answer (unexpected): {sanitized_result}")
+                    _finalize_answer(context, original_user_input, _result_text(result), query_embedding,
+                                     label="Final Answer (unexpected)", exact_cache=semantic_cache_enabled)
                     break
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, asyncio.CancelledError, EOFError):
         print("\n👋 Received exit signal. Shutting down...")
+    finally:
+        await _drain_index_tasks()
+        await _indexer_module().aclose_http_clients()
+        await get_model_manager().aclose_http_clients()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
 
 
 
@@ -0,0 +1,42 @@
+# core/config.py
+
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict
+
+import yaml
+
+ROOT = Path(__file__).parent.parent
+PROFILE_YAML = ROOT / "config" / "profiles.yaml"
+
+# Prefer the libyaml C loader when PyYAML was built with it
+_Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+@lru_cache(maxsize=8)
+def _load_yaml(path: str, mtime: float) -> Dict[str, Any]:
+    with open(path, "r") as f:
+        return yaml.load(f, Loader=_Loader) or {}
+
+
+def load_profile(path: Path = PROFILE_YAML) -> Dict[str, Any]:
+    """
+    Load profiles.yaml, re-parsing only when the file's mtime changes.
+
+    The returned dict is shared between callers; treat it as read-only.
+    """
+    path = str(path)
+    return _load_yaml(path, os.path.getmtime(path))
+
+
+def get_mcp_servers(path: Path = PROFILE_YAML) -> Dict[str, Dict[str, Any]]:
+    """Return the configured MCP servers keyed by server id."""
+    path = str(path)
+    return _mcp_servers(path, os.path.getmtime(path))
+
+
+@lru_cache(maxsize=8)
+def _mcp_servers(path: str, mtime: float) -> Dict[str, Dict[str, Any]]:
+    profile = _load_yaml(path, mtime)
+    return {server["id"]: server for server in profile.get("mcp_servers", [])}
@@ -1,17 +1,17 @@
 # modules/loop.py
 
 import asyncio
-import json
 from modules.perception import run_perception
 from modules.decision import generate_plan
 from modules.action import run_python_sandbox
-from modules.model_manager import ModelManager
+from modules.model_manager import get_model_manager
 from core.session import MultiMCP
 from core.strategy import select_decision_prompt_path
 from core.context import AgentContext
-from modules.tools import summarize_tools, extract_python_code_block
+from modules.tools import extract_python_code_block, head_by_tokens, loads_json
 from modules.guardrail import check_result
 import re
+from typing import Dict, Optional, Tuple
 
 try:
     from agent import log
@@ -21,15 +21,164 @@ except ImportError:
         now = datetime.datetime.now().strftime("%H:%M:%S")
         print(f"[{now}] [{stage}] {msg}")
 
+_SOLVE_RE = re.compile(r"^\s*(async\s+)?def\s+solve\s*\(", re.MULTILINE)
+
+# Markers of the user_input_override built for FURTHER_PROCESSING_REQUIRED
+_FURTHER_MARK = "Your last tool produced this result:"
+_CRITICAL = "❗CRITICAL:"
+_ORIG_TASK = "Original user task:"
+_MARKERS = (_FURTHER_MARK, _CRITICAL, _ORIG_TASK)
+_MARKER_RE = re.compile("|".join(map(re.escape, _MARKERS)))
+
+MAX_ANALYSIS_TOKENS = 12500  # Budget for tool content in direct-analysis prompts (~50k chars)
+
+# Static system prompts: kept byte-identical across calls so the provider's prompt-prefix
+# cache applies; only the user prompt carries the per-query task, content and history
+_DIRECT_SYS = """You are a helpful AI assistant. The user's query doesn't require any tools - it's a simple question or greeting that you can answer directly.
+
+Please provide a helpful, concise response. If it's a greeting, respond warmly. If it's a question, answer it directly based on your knowledge."""
+
+_DIRECT_CTX_SYS = """You are a helpful AI assistant. The user's query doesn't require any tools - it's a simple question or greeting that you can answer directly.
+
+Please provide a helpful, concise response. If it's a greeting, respond warmly. If it's a question, answer it directly based on your knowledge and the context from previous conversations if relevant."""
+
+_ANALYSIS_SYS = """You are a helpful AI assistant. Analyze the content provided by the user and provide a clear, comprehensive answer to the user's question.
+
+Your task: Analyze this content and provide a clear, well-structured answer. If the user asked to summarize or explain, provide a comprehensive summary. If they asked a specific question, answer it based on the content.
+
+Respond with FINAL_ANSWER: [your analysis and answer]"""
+
+# User-prompt templates: only the named fragments are substituted per call
+_FALLBACK_NO_CTX_TMPL = 'The user asked: "{query}"\n\nYour response:'
+_FALLBACK_WITH_CTX_TMPL = (
+    'The user asked: "{query}"\n\n'
+    "Here are some relevant previous conversations for context:\n{history}\n\n"
+    "Your response:"
+)
+_ANALYSIS_TMPL = _ORIG_TASK + " {task}\n\nContent to analyze:\n{content}"
+# FURTHER_PROCESSING_REQUIRED override: per-run header + tool content + this footer
+_OVERRIDE_FOOTER = (
+    "\n\n" + _CRITICAL + " Analyze the content above and return FINAL_ANSWER. "
+    "DO NOT call any tools - the content is already provided!\n\n"
+    "Return: FINAL_ANSWER: [your analysis]"
+)
+
+def _scan_markers(s: str) -> Dict[str, Tuple[int, int]]:
+    """Find every override marker in one pass over s: marker -> (first, last) start offset."""
+    positions = {}
+    for match in _MARKER_RE.finditer(s):
+        first = positions.get(match.group(), (match.start(),))[0]
+        positions[match.group()] = (first, match.start())
+    return positions
+
+def _extract_between(s: str, start_marker: str, end_marker: str, last: bool = True, markers: Optional[Dict] = None):
+    """
+    Return the stripped text between start_marker and end_marker.
+    
+    Args:
+        s: Text to scan
+        start_marker: First occurrence marks the start (exclusive)
+        end_marker: Last occurrence (or first after the start if last=False) marks the end;
+            if missing, the rest of s is taken
+        last: Whether to use the last occurrence of end_marker
+        markers: _scan_markers(s) result; marker positions are looked up there instead of rescanning s
+    
+    Returns:
+        The extracted text, or None if start_marker is not in s
+    """
+    if markers is not None and start_marker in _MARKERS:
+        start = markers[start_marker][0] if start_marker in markers else -1
+    else:
+        start = s.find(start_marker)
+    if start < 0:
+        return None
+    start += len(start_marker)
+    if markers is not None and last and end_marker in _MARKERS:
+        end = markers[end_marker][1] if end_marker in markers else -1
+        end = end if end >= start else -1
+    else:
+        end = s.rfind(end_marker, start) if last else s.find(end_marker, start)
+    return (s[start:end] if end >= 0 else s[start:]).strip()
+
+def _truncate_for_analysis(content: str) -> str:
+    """Cut content to MAX_ANALYSIS_TOKENS, noting the truncation for the LLM."""
+    orig_len = len(content)
+    head, n_tokens = head_by_tokens(content, MAX_ANALYSIS_TOKENS)
+    if len(head) == orig_len:
+        return content
+    return "".join((head, "\n\n[Content truncated - showing first ", str(n_tokens), " tokens of ", str(orig_len), " characters total]"))
+
 class AgentLoop:
     def __init__(self, context: AgentContext):
         self.context = context
         self.mcp = self.context.dispatcher
-        self.model = ModelManager()
+        self.model = get_model_manager()
+
+    async def _llm_answer(self, prompt: str, system_prompt: str, tool_name: str, tool_args: dict, tags: list) -> dict:
+        """Answer straight from the LLM (no tools), record it in session memory and return the done result."""
+        answer = (await self.model.generate_text(prompt, system_prompt=system_prompt)).strip()
+        # Ensure it starts with FINAL_ANSWER if it doesn't already
+        if not answer.startswith("FINAL_ANSWER:"):
+            answer = "FINAL_ANSWER: " + answer
+        
+        # Store original answer (no sanitization in memory) for future searches
+        self.context.final_answer = answer
+        self.context.memory.add_tool_output(
+            tool_name=tool_name,
+            tool_args=tool_args,
+            tool_result={"result": answer},
+            success=True,
+            tags=tags,
+        )
+        return {"status": "done", "result": answer}
+
+    async def _llm_direct_analysis(self, content: str, original_task: str, tool_name: str, reason: str, tags: list) -> dict:
+        """Have the LLM analyze tool content that is already available (truncated to MAX_ANALYSIS_TOKENS)."""
+        analysis_prompt = _ANALYSIS_TMPL.format_map({"task": original_task, "content": _truncate_for_analysis(content)})
+        return await self._llm_answer(analysis_prompt, _ANALYSIS_SYS, tool_name, {"reason": reason}, tags)
+
+    async def _fetch_fallback_history(self, query: str) -> str:
+        """Search historical conversations and format the top 3 for the no-tools fallback prompt."""
+        try:
+            # Search for relevant historical conversations
+            search_input = {"input": {"query": query}}
+            historical_result = await self.mcp.call_tool(
+                'search_historical_conversations', 
+                search_input
+            )
+            
+            # Parse the result
+            if historical_result and hasattr(historical_result, 'content'):
+                try:
+                    historical_data = loads_json(historical_result.content[0].text).get("result", [])
+                    
+                    if historical_data and len(historical_data) > 0:
+                        # Format historical context for the prompt
+                        context_items = []
+                        for conv in historical_data[:3]:  # Top 3 most relevant
+                            context_items.append(
+                                f"Previous conversation:\n"
+                                f"  User: {conv.get('user_query', '')}\n"
+                                f"  Assistant: {conv.get('final_answer', '')}"
+                            )
+                        log("loop", f"📚 Found {len(historical_data)} relevant historical conversations")
+                        return "\n\n".join(context_items)
+                except Exception as e:
+                    log("loop", f"⚠️ Could not parse historical conversations: {e}")
+        except Exception as e:
+            log("loop", f"⚠️ Could not search historical conversations: {e}")
+        return ""
 
     async def run(self):
         max_steps = self.context.agent_profile.strategy.max_steps
         further_processing_count = 0  # Track FURTHER_PROCESSING_REQUIRED loops
+        # Task is fixed for the run, so the static part of the FURTHER_PROCESSING_REQUIRED override is too
+        override_header = f"{_ORIG_TASK} {self.context.user_input}\n\n{_FURTHER_MARK}\n\n"
+        # Strategy is fixed for the run, so the decision prompt is too
+        prompt_path = select_decision_prompt_path(
+            planning_mode=self.context.agent_profile.strategy.planning_mode,
+            exploration_mode=self.context.agent_profile.strategy.exploration_mode,
+        )
 
         for step in range(max_steps):
             print(f"🔁 Step {step+1}/{max_steps} starting...")
@@ -54,82 +203,28 @@ class AgentLoop:
                     log("loop", "⚠️ No tools selected — checking historical conversations and using LLM fallback.")
                     
                     # Search historical conversations for context
-                    historical_context = ""
-                    try:
-                        # Search for relevant historical conversations
-                        search_input = {"input": {"query": self.context.user_input}}
-                        historical_result = await self.mcp.call_tool(
-                            'search_historical_conversations', 
-                            search_input
-                        )
-                        
-                        # Parse the result
-                        if historical_result and hasattr(historical_result, 'content'):
-                            try:
-                                historical_data = json.loads(historical_result.content[0].text).get("result", [])
-                                
-                                if historical_data and len(historical_data) > 0:
-                                    # Format historical context for the prompt
-                                    context_items = []
-                                    for conv in historical_data[:3]:  # Top 3 most relevant
-                                        context_items.append(
-                                            f"Previous conversation:\n"
-                                            f"  User: {conv.get('user_query', '')}\n"
-                                            f"  Assistant: {conv.get('final_answer', '')}"
-                                        )
-                                    historical_context = "\n\n".join(context_items)
-                                    log("loop", f"📚 Found {len(historical_data)} relevant historical conversations")
-                            except Exception as e:
-                                log("loop", f"⚠️ Could not parse historical conversations: {e}")
-                    except Exception as e:
-                        log("loop", f"⚠️ Could not search historical conversations: {e}")
+                    historical_context = await self._fetch_fallback_history(self.context.user_input)
                     
                     # Build enhanced prompt with historical context
                     current_user_input = self.context.user_input_override if self.context.user_input_override else self.context.user_input
                     
                     if historical_context:
-                        fallback_prompt = f"""You are a helpful AI assistant. The user asked: "{current_user_input}"
-
-This query doesn't require any tools - it's a simple question or greeting that you can answer directly.
-
-Here are some relevant previous conversations for context:
-{historical_context}
-
-Please provide a helpful, concise response. If it's a greeting, respond warmly. If it's a question, answer it directly based on your knowledge and the context from previous conversations if relevant.
-
-Your response:"""
+                        fallback_sys = _DIRECT_CTX_SYS
+                        fallback_prompt = _FALLBACK_WITH_CTX_TMPL.format_map({"query": current_user_input, "history": historical_context})
                     else:
-                        fallback_prompt = f"""You are a helpful AI assistant. The user asked: "{current_user_input}"
-
-This query doesn't require any tools - it's a simple question or greeting that you can answer directly.
-
-Please provide a helpful, concise response. If it's a greeting, respond warmly. If it's a question, answer it directly based on your knowledge.
-
-Your response:"""
+                        fallback_sys = _DIRECT_SYS
+                        fallback_prompt = _FALLBACK_NO_CTX_TMPL.format_map({"query": current_user_input})
                     
                     try:
-                        direct_answer = await self.model.generate_text(fallback_prompt)
-                        direct_answer = direct_answer.strip()
-                        
-                        # Ensure it starts with FINAL_ANSWER if it doesn't already
-                        if not direct_answer.startswith("FINAL_ANSWER:"):
-                            direct_answer = "FINAL_ANSWER: " + direct_answer
-                        
-                        # Store original direct answer (no sanitization in memory)
-                        self.context.final_answer = direct_answer
-                        
-                        # Store in memory for future searches
-                        self.context.memory.add_tool_output(
+                        result = await self._llm_answer(
+                            fallback_prompt, fallback_sys,
                             tool_name="direct_llm_response",
                             tool_args={"user_input": current_user_input},
-                            tool_result={"result": self.context.final_answer},
-                            success=True,
                             tags=["greeting", "simple_query"] if perception.intent == "greeting" else ["simple_query"],
                         )
-                        
                         log("loop", f"✅ Generated direct answer with historical context (no tools needed)")
                         # Return early instead of breaking to prevent going through all steps
-                        return {"status": "done", "result": self.context.final_answer}
+                        return result
                     except Exception as e:
                         log("loop", f"❌ Error generating direct answer: {e}")
                         self.context.final_answer = "FINAL_ANSWER: I apologize, but I encountered an error while processing your request."
@@ -140,66 +235,30 @@ Your response:"""
                 current_user_input = self.context.user_input_override if self.context.user_input_override else self.context.user_input
                 
                 # ❗STRICT: If content is already provided via "Your last tool produced this result:", use LLM directly
-                if "Your last tool produced this result:" in current_user_input:
-                    # Extract the content from the message
+                markers = _scan_markers(current_user_input)
+                if _FURTHER_MARK in markers:
+                    # Extract the content from the message, dropping the instruction lines at the end
                     try:
-                        content_start = current_user_input.find("Your last tool produced this result:") + len("Your last tool produced this result:")
-                        content = current_user_input[content_start:].strip()
-                        # Remove the instruction lines at the end
-                        if "❗CRITICAL:" in content:
-                            content = content[:content.find("❗CRITICAL:")].strip()
+                        content = _extract_between(current_user_input, _FURTHER_MARK, _CRITICAL, markers=markers)
                         
                         log("loop", "🔍 Content already provided - using LLM directly to analyze (bypassing tool selection)")
                         
-                        # Truncate content if too long
-                        content_to_analyze = content[:50000] if len(content) > 50000 else content
-                        if len(content) > 50000:
-                            content_to_analyze += f"\n\n[Content truncated - showing first 50000 characters of {len(content)} total]"
-                        
                         # Extract original task
-                        original_task = self.context.user_input
-                        if "Original user task:" in current_user_input:
-                            task_start = current_user_input.find("Original user task:") + len("Original user task:")
-                            task_end = current_user_input.find("\n\n", task_start)
-                            if task_end > 0:
-                                original_task = current_user_input[task_start:task_end].strip()
-                        
-                        # Use LLM directly to analyze
-                        analysis_prompt = f"""You are a helpful AI assistant. Analyze the following content and provide a clear, comprehensive answer to the user's question.
-
-Original user task: {original_task}
-
-Content to analyze:
-{content_to_analyze}
-
-Your task: Analyze this content and provide a clear, well-structured answer. If the user asked to summarize or explain, provide a comprehensive summary. If they asked a specific question, answer it based on the content.
-
-Respond with FINAL_ANSWER: [your analysis and answer]"""
+                        original_task = _extract_between(current_user_input, _ORIG_TASK, "\n\n", last=False, markers=markers) or self.context.user_input
                         
-                        llm_answer = await self.model.generate_text(analysis_prompt)
-                        llm_answer = llm_answer.strip()
-                        if not llm_answer.startswith("FINAL_ANSWER:"):
-                            llm_answer = "FINAL_ANSWER: " + llm_answer
-                        
-                        self.context.final_answer = llm_answer
-                        self.context.memory.add_tool_output(
+                        result = await self._llm_direct_analysis(
+                            content, original_task,
                             tool_name="llm_direct_analysis",
-                            tool_args={"reason": "Content provided via FURTHER_PROCESSING_REQUIRED"},
-                            tool_result={"result": self.context.final_answer},
-                            success=True,
+                            reason="Content provided via FURTHER_PROCESSING_REQUIRED",
                             tags=["direct_analysis", "llm"],
                         )
                         log("loop", "✅ LLM direct analysis completed")
-                        return {"status": "done", "result": self.context.final_answer}
+                        return result
                     except Exception as e:
                         log("loop", f"⚠️ Error in direct LLM analysis: {e}, falling back to normal planning")
                         # Fall through to normal planning if direct analysis fails
                 
-                tool_descriptions = summarize_tools(selected_tools)
-                prompt_path = select_decision_prompt_path(
-                    planning_mode=self.context.agent_profile.strategy.planning_mode,
-                    exploration_mode=self.context.agent_profile.strategy.exploration_mode,
-                )
+                tool_descriptions = self.mcp.get_tool_summary(selected_servers)
                 
                 # Enhance user input with historical context if available (same as perception layer)
                 historical_context = getattr(self.context, "historical_context", None)
@@ -223,12 +282,12 @@ Use this context to inform your tool selection and search strategy."""
                 print(f"[plan] {plan}")
 
                 # === Execution ===
-                if re.search(r"^\s*(async\s+)?def\s+solve\s*\(", plan, re.MULTILINE):
+                if _SOLVE_RE.search(plan):
                     print("[loop] Detected solve() plan — running sandboxed...")
                     # Extract clean Python code (handles markdown code blocks or uses plan as-is)
                     code = extract_python_code_block(plan)
                     # Verify we still have a valid solve() function after extraction
-                    if not re.search(r"^\s*(async\s+)?def\s+solve\s*\(", code, re.MULTILINE):
+                    if not _SOLVE_RE.search(code):
                         code = plan  # Fallback to original if extraction removed the function
                     print("\nextracted code to run:", code[:200] + "..." if len(code) > 200 else code)
                     self.context.log_subtask(tool_name="solve_sandbox", status="pending")
@@ -265,60 +324,28 @@ Use this context to inform your tool selection and search strategy."""
                                 log("loop", f"⚠️ Detected loop with FURTHER_PROCESSING_REQUIRED (count: {further_processing_count}). Using LLM fallback to analyze content.")
                                 try:
                                     # Use LLM directly to analyze the provided content
-                                    # Truncate content if too long (max 50000 chars)
-                                    content_to_analyze = content[:50000] if len(content) > 50000 else content
-                                    if len(content) > 50000:
-                                        content_to_analyze += f"\n\n[Content truncated - showing first 50000 characters of {len(content)} total]"
-                                    
-                                    analysis_prompt = f"""You are a helpful AI assistant. Analyze the following content and provide a clear, comprehensive answer to the user's question.
-
-Original user task: {self.context.user_input}
-
-Content to analyze:
-{content_to_analyze}
-
-Your task: Analyze this content and provide a clear, well-structured answer. If the user asked to summarize or explain, provide a comprehensive summary. If they asked a specific question, answer it based on the content.
-
-Respond with FINAL_ANSWER: [your analysis and answer]"""
-                                    
-                                    llm_answer = await self.model.generate_text(analysis_prompt)
-                                    llm_answer = llm_answer.strip()
-                                    if not llm_answer.startswith("FINAL_ANSWER:"):
-                                        llm_answer = "FINAL_ANSWER: " + llm_answer
-                                    
-                                    self.context.final_answer = llm_answer
-                                    self.context.memory.add_tool_output(
+                                    result = await self._llm_direct_analysis(
+                                        content, self.context.user_input,
                                         tool_name="llm_fallback_analysis",
-                                        tool_args={"reason": "FURTHER_PROCESSING_REQUIRED loop detected"},
-                                        tool_result={"result": self.context.final_answer},
-                                        success=True,
+                                        reason="FURTHER_PROCESSING_REQUIRED loop detected",
                                         tags=["fallback", "llm_analysis"],
                                     )
                                     log("loop", "✅ LLM fallback analysis completed")
-                                    return {"status": "done", "result": self.context.final_answer}
+                                    return result
                                 except Exception as e:
                                     log("loop", f"❌ LLM fallback failed: {e}")
                                     # Continue with normal flow if fallback fails
                             
                             # No guardrail checks on intermediate results - use original content
-                            self.context.user_input_override  = (
-                                f"Original user task: {self.context.user_input}\n\n"
-                                f"Your last tool produced this result:\n\n"
-                                f"{content}\n\n"
-                                f"❗CRITICAL: Analyze the content above and return FINAL_ANSWER. DO NOT call any tools - the content is already provided!\n\n"
-                                f"Return: FINAL_ANSWER: [your analysis]"
-                            )
+                            self.context.user_input_override = "".join((override_header, content, _OVERRIDE_FOOTER))
                             # Truncate content for display (keep full content in user_input_override)
                             MAX_DISPLAY_LENGTH = 500
                             if len(content) > MAX_DISPLAY_LENGTH:
-                                truncated_content = content[:MAX_DISPLAY_LENGTH] + f"\n... [truncated {len(content) - MAX_DISPLAY_LENGTH} more characters]"
-                                display_override = (
-                                    f"Original user task: {self.context.user_input}\n\n"
-                                    f"Your last tool produced this result:\n\n"
-                                    f"{truncated_content}\n\n"
-                                    f"❗CRITICAL: Analyze the content above and return FINAL_ANSWER. DO NOT call any tools!\n\n"
-                                    f"Return: FINAL_ANSWER: [your analysis]"
-                                )
+                                display_override = "".join((
+                                    override_header, content[:MAX_DISPLAY_LENGTH],
+                                    "\n... [truncated ", str(len(content) - MAX_DISPLAY_LENGTH), " more characters]",
+                                    _OVERRIDE_FOOTER,
+                                ))
                             else:
                                 display_override = self.context.user_input_override
                             log("loop", f"📨 Forwarding intermediate result to next step:\n{display_override}\n\n")
@@ -5,6 +5,7 @@ import sys
 from typing import Optional, Any, List, Dict
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
+from modules.tools import summarize_tools
 
 
 class MCP:
@@ -58,10 +59,12 @@ class MultiMCP:
         self.server_configs = server_configs
         self.tool_map: Dict[str, Dict[str, Any]] = {}  # tool_name → {config, tool}
         self.server_tools: Dict[str, List[Any]] = {}  # server_name -> list of tools
+        self._summary_cache: Dict[tuple, str] = {}  # selected servers -> summarize_tools() output
 
 
     async def initialize(self):
         print("in MultiMCP initialize")
+        self._summary_cache.clear()  # Tool registry is being rescanned
         for config in self.server_configs:
             try:
                 params = StdioServerParameters(
@@ -123,6 +126,14 @@ class MultiMCP:
                 tools.extend(self.server_tools[server])
         return tools
 
+    def get_tool_summary(self, selected_servers: List[str]) -> str:
+        """Prompt summary of the tools on selected_servers, cached until the next initialize()."""
+        key = tuple(selected_servers)
+        summary = self._summary_cache.get(key)
+        if summary is None:
+            summary = self._summary_cache[key] = summarize_tools(self.get_tools_from_servers(key))
+        return summary
+
 
 
     async def shutdown(self):
@@ -3,7 +3,7 @@
 from typing import List, Optional, Any
 from modules.perception import PerceptionResult
 from modules.memory import MemoryItem
-from modules.model_manager import ModelManager
+from modules.model_manager import get_model_manager
 from core.context import AgentContext
 from modules.tools import filter_tools_by_hint, summarize_tools, load_prompt
 
@@ -27,7 +27,7 @@ def select_decision_prompt_path(planning_mode: str, exploration_mode: Optional[s
             return "prompts/decision_prompt_exploratory_sequential.txt"
     return "prompts/decision_prompt_conservative.txt"  # safe fallback
 
-model = ModelManager()
+model = get_model_manager()
 
 async def decide_next_action(
     context: AgentContext,
@@ -3,29 +3,154 @@ Conversation Indexer - Vector indexing for historical conversations
 Indexes conversations after completion for semantic search.
 """
 
+import asyncio
+import atexit
+import hashlib
 import json
 import os
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
 import faiss
 import numpy as np
-import requests
+import httpx
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, asdict
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import List, Dict, NamedTuple, Optional, Tuple, Union
 from datetime import datetime
+from core.config import load_profile
+
+try:
+    import orjson  # Optional: much faster metadata (de)serialization
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl  # POSIX advisory locks between writer processes
+except ImportError:
+    fcntl = None
 
 # Embedding configuration (same as document indexing)
 EMBED_URL = "http://localhost:11434/api/embeddings"
+EMBED_BATCH_URL = "http://localhost:11434/api/embed"  # Accepts a list of inputs, returns L2-normalized vectors
 EMBED_MODEL = "nomic-embed-text"
 
 # Storage paths
 ROOT = Path(__file__).parent.parent.resolve()
 INDEX_FILE = ROOT / "historical_conversation_index.bin"
-METADATA_FILE = ROOT / "historical_conversation_store.json"
+QUERY_INDEX_FILE = ROOT / "historical_query_index.bin"
+METADATA_FILE = ROOT / "historical_conversation_store.json"  # Legacy single-document store, migrated on load
+METADATA_LOG = ROOT / "historical_conversation_store.jsonl"  # Append-only, one conversation per line
+QUERY_EMBEDDING_CACHE = ROOT / "query_embedding_cache.sqlite"  # Shared by the agent and the MCP servers
+INDEX_LOCK_FILE = ROOT / "historical_conversation_index.lock"  # Held while the index files are written
+
+# Query embeddings kept on disk (LRU by last use); the memory server is a fresh
+# process per tool call, so an in-process cache would never be hit there
+QUERY_EMBEDDING_CACHE_SIZE = 2048
+
+# HNSW graph parameters for the main index (vectors are L2-normalized, so L2 ranks like cosine)
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# Storage dtype for indexed vectors (memory.embedding_dtype in profiles.yaml). The fp16
+# default halves the bytes of every distance computation versus float32, with no measurable
+# effect on top-k for normalized embeddings. Changing it migrates the indexes on next load.
+EMBEDDING_DTYPES = {
+    "float32": None,  # Uncompressed: IndexHNSWFlat / IndexFlatIP
+    "float16": faiss.ScalarQuantizer.QT_fp16,
+}
+if hasattr(faiss.ScalarQuantizer, "QT_bf16"):  # FAISS >= 1.8
+    EMBEDDING_DTYPES["bfloat16"] = faiss.ScalarQuantizer.QT_bf16
+DEFAULT_EMBEDDING_DTYPE = "float16"
+
+
+def _embedding_dtype() -> str:
+    try:
+        dtype = load_profile().get("memory", {}).get("embedding_dtype", DEFAULT_EMBEDDING_DTYPE)
+    except Exception:
+        return DEFAULT_EMBEDDING_DTYPE
+    if dtype not in EMBEDDING_DTYPES:
+        print(f"[conversation_indexer] Unknown embedding_dtype {dtype!r}, using {DEFAULT_EMBEDDING_DTYPE}")
+        return DEFAULT_EMBEDDING_DTYPE
+    return dtype
+
+
+EMBEDDING_DTYPE = _embedding_dtype()
+VECTOR_CODEC = EMBEDDING_DTYPES[EMBEDDING_DTYPE]  # ScalarQuantizer type, or None for float32
+
+# FAISS index files are checkpointed after this many inserts or seconds, whichever comes
+# first (metadata is appended on every insert; missing vectors are rebuilt on load)
+CHECKPOINT_EVERY = 16
+CHECKPOINT_INTERVAL = 5.0
+
+# Answers that must never be served back from the semantic cache
+# (lowercase; the last one is the loop's apology when a run fails)
+UNCACHEABLE_MARKERS = ("[max steps reached]", "[result blocked", "[error", "[execution failed]", "[sandbox error:",
+                       "i encountered an error while processing your request")
+
+
+def _searchable_text(user_query: str, final_answer: str, tool_calls: Optional[List[Dict]]) -> str:
+    """Text embedded into the main index for a conversation (query + answer + tools used)."""
+    text = f"{user_query}\n{final_answer}"
+    if tool_calls:
+        tool_summary = ", ".join([tc.get("tool_name", "") for tc in tool_calls])
+        text += f"\nTools used: {tool_summary}"
+    return text
+
+
+def _dump_line(entry: Dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(entry, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def _load_line(line: bytes) -> Dict:
+    return orjson.loads(line) if orjson is not None else json.loads(line)
+
+
+@dataclass(slots=True)
+class ToolCallRecord:
+    """A tool call made while answering a conversation."""
+    tool_name: str
+    tool_args: dict
+    success: bool
+
+
+class SearchHit(NamedTuple):
+    """A search result: the stored conversation metadata (shared - do not mutate) and its distance."""
+    meta: Dict
+    distance: float
+
+
+# Keep-alive HTTP clients for Ollama: one shared sync client, one async client per event loop
+_http_limits = httpx.Limits(max_keepalive_connections=8)
+_http_client = httpx.Client(timeout=10, limits=_http_limits)
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+
+def _async_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = _async_clients[loop] = httpx.AsyncClient(timeout=30, limits=_http_limits)
+    return client
+
+
+async def aclose_http_clients():
+    """Close the current event loop's async HTTP client (call before the loop shuts down)."""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
 
 
 def get_embedding(text: str) -> np.ndarray:
     """Get embedding vector for text using Ollama."""
     try:
-        result = requests.post(EMBED_URL, json={"model": EMBED_MODEL, "prompt": text}, timeout=10)
+        result = _http_client.post(EMBED_URL, json={"model": EMBED_MODEL, "prompt": text})
         result.raise_for_status()
         return np.array(result.json()["embedding"], dtype=np.float32)
     except Exception as e:
@@ -34,56 +159,536 @@ def get_embedding(text: str) -> np.ndarray:
         return np.zeros(768, dtype=np.float32)  # nomic-embed-text dimension
 
 
+def _batch_embeddings(payload: Dict, count: int) -> np.ndarray:
+    embeddings = np.array(payload["embeddings"], dtype=np.float32)
+    if embeddings.shape[0] != count:
+        raise ValueError(f"expected {count} embeddings, got {embeddings.shape[0]}")
+    return embeddings
+
+
+def get_embeddings(texts: List[str]) -> np.ndarray:
+    """
+    Embed several texts in one Ollama request.
+    
+    The batch endpoint returns L2-normalized vectors; every index normalizes
+    its vectors anyway. Falls back to one get_embedding() call per text if the
+    batch endpoint is unavailable.
+    
+    Returns:
+        Array of shape (len(texts), dim)
+    """
+    if not texts:
+        return np.zeros((0, 768), dtype=np.float32)
+    try:
+        result = _http_client.post(EMBED_BATCH_URL, json={"model": EMBED_MODEL, "input": texts}, timeout=30)
+        result.raise_for_status()
+        return _batch_embeddings(result.json(), len(texts))
+    except Exception as e:
+        print(f"[conversation_indexer] Warning: Batch embedding failed ({e}), embedding one by one")
+        return np.vstack([get_embedding(text) for text in texts])
+
+
+async def _aget_embeddings(texts: List[str]) -> np.ndarray:
+    """Async get_embeddings over the event loop's keep-alive client."""
+    try:
+        result = await _async_client().post(EMBED_BATCH_URL, json={"model": EMBED_MODEL, "input": texts})
+        result.raise_for_status()
+        return _batch_embeddings(result.json(), len(texts))
+    except Exception as e:
+        print(f"[conversation_indexer] Warning: Batch embedding failed ({e}), embedding one by one")
+        return await asyncio.to_thread(lambda: np.vstack([get_embedding(text) for text in texts]))
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent embedding requests on one event loop into a single
+    /api/embed call. A worker task takes up to max_batch queued texts, waiting
+    at most max_latency seconds after the first one arrives.
+    """
+    
+    def __init__(self, max_batch: int = 32, max_latency: float = 0.01):
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+    
+    async def embed(self, text: str) -> np.ndarray:
+        """Embed one text, sharing the HTTP request with any concurrent callers."""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((text, future))
+        return await future
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_latency
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Identical texts in one batch (e.g. the same query from parallel tool calls) are embedded once
+            unique_texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                embeddings = await _aget_embeddings(unique_texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            by_text = dict(zip(unique_texts, embeddings))
+            for text, future in batch:
+                if not future.done():
+                    future.set_result(by_text[text])
+
+
+# One batcher per event loop (its worker task and futures are loop-bound)
+_batchers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, EmbeddingBatcher]" = weakref.WeakKeyDictionary()
+
+
+async def get_embedding_async(text: str) -> np.ndarray:
+    """Async get_embedding: concurrent calls are batched into one Ollama request."""
+    loop = asyncio.get_running_loop()
+    batcher = _batchers.get(loop)
+    if batcher is None:
+        batcher = _batchers[loop] = EmbeddingBatcher()
+    return await batcher.embed(text)
+
+
+class QueryEmbeddingCache:
+    """
+    Persistent text -> embedding cache for user queries, in SQLite so the agent
+    process and the per-call MCP server processes can share it. Any SQLite error
+    just disables the cache for that call; embeddings are then computed as usual.
+    """
+    
+    def __init__(self, path: Path = QUERY_EMBEDDING_CACHE, max_entries: int = QUERY_EMBEDDING_CACHE_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._puts = 0
+    
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=1.0, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings "
+                "(key BLOB PRIMARY KEY, embedding BLOB NOT NULL, used REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+    
+    @staticmethod
+    def _key(text: str) -> bytes:
+        # Vectors depend on the embedding model, so it is part of the key
+        return hashlib.blake2b(f"{EMBED_MODEL}\0{text}".encode("utf-8"), digest_size=16).digest()
+    
+    def get(self, text: str) -> Optional[np.ndarray]:
+        key = self._key(text)
+        try:
+            with self._lock:
+                conn = self._connection()
+                row = conn.execute("SELECT embedding FROM query_embeddings WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                conn.execute("UPDATE query_embeddings SET used = ? WHERE key = ?", (time.time(), key))
+                conn.commit()
+        except sqlite3.Error as e:
+            print(f"[conversation_indexer] Warning: query embedding cache unavailable ({e})")
+            return None
+        return np.frombuffer(row[0], dtype=np.float32).copy()
+    
+    def put(self, text: str, embedding: np.ndarray):
+        vec = np.asarray(embedding, dtype=np.float32).ravel()
+        if not vec.any():
+            return  # get_embedding's zero-vector fallback: not a real embedding
+        try:
+            with self._lock:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO query_embeddings (key, embedding, used) VALUES (?, ?, ?)",
+                    (self._key(text), vec.tobytes(), time.time()),
+                )
+                # Trim to max_entries every so often rather than on every insert
+                self._puts += 1
+                if self._puts % 64 == 1:
+                    conn.execute(
+                        "DELETE FROM query_embeddings WHERE key NOT IN "
+                        "(SELECT key FROM query_embeddings ORDER BY used DESC LIMIT ?)",
+                        (self.max_entries,),
+                    )
+                conn.commit()
+        except sqlite3.Error as e:
+            print(f"[conversation_indexer] Warning: could not cache query embedding ({e})")
+
+
+_query_embedding_cache = QueryEmbeddingCache()
+
+
+def get_query_embedding(query: str) -> np.ndarray:
+    """get_embedding for a user query, served from the persistent query cache when possible."""
+    embedding = _query_embedding_cache.get(query)
+    if embedding is None:
+        embedding = get_embedding(query)
+        _query_embedding_cache.put(query, embedding)
+    return embedding
+
+
+async def get_query_embedding_async(query: str) -> np.ndarray:
+    """Async get_query_embedding (cache misses go through the shared batcher)."""
+    embedding = _query_embedding_cache.get(query)
+    if embedding is None:
+        embedding = await get_embedding_async(query)
+        _query_embedding_cache.put(query, embedding)
+    return embedding
+
+
+def _normalized(embedding: np.ndarray) -> np.ndarray:
+    """Return a (1, dim) L2-normalized copy, so inner product equals cosine similarity and L2 ranks like it."""
+    vec = np.array(embedding, dtype=np.float32).reshape(1, -1)
+    faiss.normalize_L2(vec)
+    return vec
+
+
+def _atomic_write(path: Path, write):
+    """
+    Call write(tmp_path) on a fresh temp file next to path, then atomically replace path.
+    
+    The temp name is unique, so concurrent writers never share one, and a partial file
+    left by a killed process is never mistaken for the real one.
+    """
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _write_index(index: faiss.Index, path: Path):
+    """Write a FAISS index atomically, so a concurrent reader never sees a partial file."""
+    _atomic_write(path, lambda tmp: faiss.write_index(index, tmp))
+
+
+def _conversation_id(entry: Dict) -> int:
+    """Stable non-negative 63-bit FAISS id for a conversation, derived from session, time and query."""
+    key = f"{entry.get('session_id')}\x1f{entry.get('timestamp')}\x1f{entry.get('user_query')}".encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") & 0x7FFF_FFFF_FFFF_FFFF
+
+
+def _id_array(ids) -> np.ndarray:
+    return np.ascontiguousarray(ids, dtype=np.int64)
+
+
+def _new_index(dim: int) -> faiss.Index:
+    """Create an empty id-mapped HNSW index (EMBEDDING_DTYPE storage) for normalized conversation embeddings."""
+    if VECTOR_CODEC is None:
+        base = faiss.IndexHNSWFlat(dim, HNSW_M)
+    else:
+        base = faiss.IndexHNSWSQ(dim, VECTOR_CODEC, HNSW_M)
+    base.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    base.hnsw.efSearch = HNSW_EF_SEARCH
+    return faiss.IndexIDMap2(base)
+
+
+def _new_query_index(dim: int) -> faiss.Index:
+    """Create an empty id-mapped exact inner-product index (EMBEDDING_DTYPE storage) for normalized query embeddings."""
+    if VECTOR_CODEC is None:
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+    return faiss.IndexIDMap2(faiss.IndexScalarQuantizer(dim, VECTOR_CODEC, faiss.METRIC_INNER_PRODUCT))
+
+
+def _codec_of(base: faiss.Index) -> Optional[int]:
+    """ScalarQuantizer type of a (downcast) base index, or None if it stores raw floats."""
+    if isinstance(base, faiss.IndexHNSW):
+        base = faiss.downcast_index(base.storage)
+    return base.sq.qtype if isinstance(base, faiss.IndexScalarQuantizer) else None
+
+
+def _is_current_layout(index: faiss.Index, new_index) -> bool:
+    """True if index has the id-mapped layout and storage dtype that new_index() builds today."""
+    if not isinstance(index, faiss.IndexIDMap2):
+        return False
+    base = faiss.downcast_index(index.index)
+    expected = faiss.downcast_index(new_index(index.d).index)
+    return type(base) is type(expected) and _codec_of(base) == _codec_of(expected)
+
+
+def _index_contents(index: faiss.Index, positional_ids: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Stored vectors of an index and their conversation ids.
+    
+    Args:
+        index: Id-mapped index, or an older positional one (row i = i-th conversation)
+        positional_ids: Conversation ids in metadata order, used for positional indexes
+    """
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        ids = faiss.vector_to_array(index.id_map).astype(np.int64)
+        base = faiss.downcast_index(index.index)
+    else:
+        base = index
+        ids = _id_array(positional_ids[:index.ntotal]) if positional_ids is not None else _id_array([])
+    vectors = base.reconstruct_n(0, len(ids)) if len(ids) else np.zeros((0, index.d), dtype=np.float32)
+    return np.ascontiguousarray(vectors, dtype=np.float32), ids
+
+
+def _migrate_index(index: faiss.Index, positional_ids: np.ndarray, new_index=_new_index) -> faiss.Index:
+    """
+    Rebuild an index from an older layout (raw float32 vectors in IndexFlatL2/IndexFlatIP/
+    IndexHNSWFlat, positional ids) in the current one, over normalized vectors. Stored
+    vectors are reconstructed, not re-embedded.
+    """
+    vectors, ids = _index_contents(index, positional_ids)
+    faiss.normalize_L2(vectors)
+    migrated = new_index(index.d)
+    if len(vectors):
+        migrated.add_with_ids(vectors, ids)
+    return migrated
+
+
+_NO_LOCK = nullcontext()
+
+
 class ConversationIndexer:
-    """Manages vector indexing of historical conversations."""
+    """
+    Manages vector indexing of historical conversations.
     
-    def __init__(self):
+    Only the agent process writes. The MCP servers open the same files read-only: they
+    never migrate, reconcile or rewrite anything, since they run as short-lived processes
+    (one per tool call) that can be killed at any point.
+    """
+    
+    def __init__(self, read_only: bool = False):
+        self.read_only = read_only
         self.index: Optional[faiss.Index] = None
+        self.query_index: Optional[faiss.Index] = None  # Query-only embeddings for the semantic cache
         self.metadata: List[Dict] = []
+        self._id_to_meta: Dict[int, Dict] = {}  # FAISS id ("cid") -> metadata entry
+        self._qbuf: Optional[np.ndarray] = None  # Reused (1, dim) query vector for searches
+        self._persisted = 0  # Number of metadata entries already in METADATA_LOG
+        self._unsaved = 0  # Inserts not yet written to the FAISS index files
+        self._last_save_t = time.monotonic()
+        self._flush_timer: Optional[threading.Timer] = None
+        self._lock = threading.RLock()  # Indexing may run in background threads
+        self._query_index_synced = False  # Query index checked against the metadata since the last load
+        self._disk_lock_file = None  # INDEX_LOCK_FILE while held
+        self._disk_lock_depth = 0
         self.load_index()
+        if not read_only:
+            atexit.register(self.flush)
+    
+    @contextmanager
+    def _disk_lock(self):
+        """
+        Hold the inter-process lock on the index files (reentrant; call with self._lock held).
+        
+        Without fcntl (Windows) only the in-process lock applies.
+        """
+        if self._disk_lock_depth == 0 and fcntl is not None:
+            self._disk_lock_file = open(INDEX_LOCK_FILE, "a+b")
+            fcntl.flock(self._disk_lock_file.fileno(), fcntl.LOCK_EX)
+        self._disk_lock_depth += 1
+        try:
+            yield
+        finally:
+            self._disk_lock_depth -= 1
+            if self._disk_lock_depth == 0 and self._disk_lock_file is not None:
+                fcntl.flock(self._disk_lock_file.fileno(), fcntl.LOCK_UN)
+                self._disk_lock_file.close()
+                self._disk_lock_file = None
+    
+    def _writes(self):
+        """Disk lock for the writer; readers get a no-op context and must not write."""
+        return self._disk_lock() if not self.read_only else _NO_LOCK
     
     def load_index(self):
-        """Load existing index and metadata."""
+        """Load existing index and metadata (and, in the writer, migrate or repair them)."""
+        with self._lock, self._writes():
+            self._load_index()
+    
+    def _load_index(self):
+        self._query_index_synced = False
         try:
+            self.metadata = []
+            if METADATA_LOG.exists():
+                self.metadata, intact_bytes = self._read_metadata_log()
+                self._persisted = len(self.metadata)
+                if intact_bytes is not None and not self.read_only:
+                    # Under the disk lock no append is in flight, so the tail really is torn:
+                    # cut it so later appends start on a clean line. Readers just skip it.
+                    with open(METADATA_LOG, "r+b") as f:
+                        f.truncate(intact_bytes)
+            elif METADATA_FILE.exists():
+                with open(METADATA_FILE, "rb") as f:
+                    self.metadata = orjson.loads(f.read()) if orjson is not None else json.load(f)
+                if not self.read_only:
+                    print(f"[conversation_indexer] Migrating {len(self.metadata)} conversations to {METADATA_LOG.name}")
+                    self._rewrite_metadata_log()
+            
+            # Entries written before ids were stored get the same id their vectors are migrated under
+            self._id_to_meta = {}
+            for entry in self.metadata:
+                if entry.get("cid") is None:
+                    entry["cid"] = self._unused_id(_conversation_id(entry))
+                self._id_to_meta[entry["cid"]] = entry
+            positional_ids = _id_array([entry["cid"] for entry in self.metadata])
+            
             if INDEX_FILE.exists():
                 self.index = faiss.read_index(str(INDEX_FILE))
                 print(f"[conversation_indexer] Loaded existing index with {self.index.ntotal} conversations")
+                if _is_current_layout(self.index, _new_index):
+                    faiss.downcast_index(self.index.index).hnsw.efSearch = HNSW_EF_SEARCH
+                else:
+                    print(f"[conversation_indexer] Migrating {type(self.index).__name__} to id-mapped {EMBEDDING_DTYPE} HNSW index")
+                    self.index = _migrate_index(self.index, positional_ids)
+                    if not self.read_only:  # Readers use the migrated copy in memory only
+                        _write_index(self.index, INDEX_FILE)
             else:
                 self.index = None
                 print("[conversation_indexer] No existing index found, will create new one")
             
-            if METADATA_FILE.exists():
-                with open(METADATA_FILE, "r", encoding="utf-8") as f:
-                    self.metadata = json.load(f)
+            if QUERY_INDEX_FILE.exists():
+                self.query_index = faiss.read_index(str(QUERY_INDEX_FILE))
+                if not _is_current_layout(self.query_index, _new_query_index):
+                    self.query_index = _migrate_index(self.query_index, positional_ids, _new_query_index)
+                    if not self.read_only:
+                        _write_index(self.query_index, QUERY_INDEX_FILE)
             else:
-                self.metadata = []
+                self.query_index = None
+            
+            if not self.read_only:
+                self._reconcile_index()  # Readers skip unindexed entries until the writer embeds them
         except Exception as e:
             print(f"[conversation_indexer] Error loading index: {e}")
             self.index = None
+            self.query_index = None
             self.metadata = []
+            self._id_to_meta = {}
+            self._persisted = 0
+    
+    def _reconcile_index(self):
+        """Embed conversations whose vectors were never checkpointed (e.g. after a crash)."""
+        indexed = set(faiss.vector_to_array(self.index.id_map).tolist()) if self.index is not None else set()
+        missing = [entry for entry in self.metadata if entry["cid"] not in indexed]
+        if not missing:
+            return
+        
+        print(f"[conversation_indexer] Rebuilding {len(missing)} unsaved vectors from metadata")
+        embeddings = get_embeddings([
+            _searchable_text(e.get("user_query", ""), e.get("final_answer", ""), e.get("tool_calls"))
+            for e in missing
+        ])
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        # Zero rows are get_embedding's failure fallback: leave those entries missing so the
+        # next load retries them, rather than indexing a vector that matches nothing sensibly
+        embedded = np.any(embeddings, axis=1)
+        if not embedded.all():
+            print(f"[conversation_indexer] Warning: {int((~embedded).sum())} vectors could not be embedded, will retry on next load")
+        if not embedded.any():
+            return
+        embeddings = np.ascontiguousarray(embeddings[embedded])
+        faiss.normalize_L2(embeddings)
+        if self.index is None:
+            self.index = _new_index(embeddings.shape[1])
+        self.index.add_with_ids(embeddings, _id_array([entry["cid"] for entry, ok in zip(missing, embedded) if ok]))
+        _write_index(self.index, INDEX_FILE)
+    
+    def _read_metadata_log(self) -> Tuple[List[Dict], Optional[int]]:
+        """
+        Read METADATA_LOG.
+        
+        Returns:
+            The entries, and None if the log ended cleanly, else the byte length of its
+            intact part. An unterminated or unreadable last line is either an append still
+            being written by the writer or one torn by a crash; it is skipped either way.
+        """
+        entries = []
+        offset = 0
+        with open(METADATA_LOG, "rb") as f:
+            for line in f:
+                if line.strip():
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("unterminated line")
+                        entries.append(_load_line(line))
+                    except ValueError:
+                        print("[conversation_indexer] Warning: Ignoring incomplete trailing entry in metadata log")
+                        return entries, offset
+                offset += len(line)
+        return entries, None
+    
+    def _rewrite_metadata_log(self):
+        """Write every metadata entry to a fresh log and atomically replace the old one."""
+        def write(tmp):
+            with open(tmp, "wb") as f:
+                for entry in self.metadata:
+                    f.write(_dump_line(entry))
+        with self._disk_lock():
+            _atomic_write(METADATA_LOG, write)
+        self._persisted = len(self.metadata)
     
     def save_index(self):
         """Save index and metadata to disk."""
-        try:
-            if self.index is not None:
-                os.makedirs(INDEX_FILE.parent, exist_ok=True)
-                faiss.write_index(self.index, str(INDEX_FILE))
-            
-            os.makedirs(METADATA_FILE.parent, exist_ok=True)
-            with open(METADATA_FILE, "w", encoding="utf-8") as f:
-                json.dump(self.metadata, f, indent=2)
-            
-            print(f"[conversation_indexer] Saved index with {len(self.metadata)} conversations")
-        except Exception as e:
-            print(f"[conversation_indexer] Error saving index: {e}")
+        if self.read_only:
+            return
+        with self._lock, self._disk_lock():
+            try:
+                if self.index is not None:
+                    os.makedirs(INDEX_FILE.parent, exist_ok=True)
+                    _write_index(self.index, INDEX_FILE)
+                if self.query_index is not None:
+                    _write_index(self.query_index, QUERY_INDEX_FILE)
+                self._append_metadata()
+                
+                self._unsaved = 0
+                self._last_save_t = time.monotonic()
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                print(f"[conversation_indexer] Saved index with {len(self.metadata)} conversations")
+            except Exception as e:
+                print(f"[conversation_indexer] Error saving index: {e}")
+    
+    def flush(self):
+        """Write any un-checkpointed inserts to disk (runs from the timer and at exit)."""
+        with self._lock:
+            if self._unsaved:
+                self.save_index()
+            else:
+                self._flush_timer = None
+    
+    def _append_metadata(self):
+        """Append only the metadata entries added since the last write."""
+        if self._persisted < len(self.metadata):
+            os.makedirs(METADATA_LOG.parent, exist_ok=True)
+            with self._disk_lock(), open(METADATA_LOG, "ab") as f:
+                f.write(b"".join(_dump_line(entry) for entry in self.metadata[self._persisted:]))
+            self._persisted = len(self.metadata)
     
     def index_conversation(
         self,
         session_id: str,
         user_query: str,
         final_answer: str,
-        tool_calls: Optional[List[Dict]] = None,
-        timestamp: Optional[float] = None
+        tool_calls: Optional[List[Union[ToolCallRecord, Dict]]] = None,
+        timestamp: Optional[float] = None,
+        query_embedding: Optional[np.ndarray] = None,
+        profile: Optional[str] = None
     ):
         """
         Index a completed conversation.
@@ -94,47 +699,109 @@ class ConversationIndexer:
             final_answer: Final answer provided
             tool_calls: List of tool calls made (optional)
             timestamp: Conversation timestamp (defaults to now)
+            query_embedding: Precomputed embedding of user_query (computed if not given)
+            profile: Agent profile id, used to namespace semantic cache hits
         """
+        entry, searchable_text = self._prepare_entry(session_id, user_query, final_answer, tool_calls, timestamp, profile)
+        try:
+            # Get embeddings
+            embedding = get_embedding(searchable_text)
+            if query_embedding is None:
+                query_embedding = get_query_embedding(user_query)
+            self._store(entry, embedding, query_embedding)
+        except Exception as e:
+            print(f"[conversation_indexer] ❌ Error indexing conversation: {e}")
+    
+    async def aindex_conversation(
+        self,
+        session_id: str,
+        user_query: str,
+        final_answer: str,
+        tool_calls: Optional[List[Union[ToolCallRecord, Dict]]] = None,
+        timestamp: Optional[float] = None,
+        query_embedding: Optional[np.ndarray] = None,
+        profile: Optional[str] = None
+    ):
+        """Async index_conversation: embeddings go through the shared batcher, FAISS and disk work run in a thread."""
+        entry, searchable_text = self._prepare_entry(session_id, user_query, final_answer, tool_calls, timestamp, profile)
+        try:
+            if query_embedding is None:
+                embedding, query_embedding = await asyncio.gather(
+                    get_embedding_async(searchable_text), get_query_embedding_async(user_query)
+                )
+            else:
+                embedding = await get_embedding_async(searchable_text)
+            await asyncio.to_thread(self._store, entry, embedding, query_embedding)
+        except Exception as e:
+            print(f"[conversation_indexer] ❌ Error indexing conversation: {e}")
+    
+    def _prepare_entry(self, session_id, user_query, final_answer, tool_calls, timestamp, profile):
+        """Build the metadata entry and the text embedded for semantic search."""
         if timestamp is None:
             timestamp = datetime.now().timestamp()
         
-        # Create searchable text (query + answer for semantic search)
-        searchable_text = f"{user_query}\n{final_answer}"
+        # Metadata is stored as plain dicts
         if tool_calls:
-            tool_summary = ", ".join([tc.get("tool_name", "") for tc in tool_calls])
-            searchable_text += f"\nTools used: {tool_summary}"
+            tool_calls = [asdict(tc) if isinstance(tc, ToolCallRecord) else tc for tc in tool_calls]
         
-        try:
-            # Get embedding
-            embedding = get_embedding(searchable_text)
-            
-            # Initialize index if needed
-            if self.index is None:
-                dim = len(embedding)
-                self.index = faiss.IndexFlatL2(dim)
-                print(f"[conversation_indexer] Created new index with dimension {dim}")
-            
-            # Add to index
-            self.index.add(embedding.reshape(1, -1))
+        # Create searchable text (query + answer for semantic search)
+        searchable_text = _searchable_text(user_query, final_answer, tool_calls)
+        
+        entry = {
+            "session_id": session_id,
+            "user_query": user_query,
+            "final_answer": final_answer,
+            "tool_calls": tool_calls or [],
+            "timestamp": timestamp,
+            "cid": None,  # FAISS id, assigned when stored
+            "profile": profile
+        }
+        return entry, searchable_text
+    
+    def _store(self, entry: Dict, embedding: np.ndarray, query_embedding: np.ndarray):
+        """Add an embedded conversation to the indexes and save (safe to call from any thread)."""
+        if self.read_only:
+            raise RuntimeError("conversation index is open read-only in this process")
+        with self._lock:
+            cid = entry["cid"] = self._unused_id(_conversation_id(entry))
             
-            # Store metadata
-            metadata_entry = {
-                "session_id": session_id,
-                "user_query": user_query,
-                "final_answer": final_answer,
-                "tool_calls": tool_calls or [],
-                "timestamp": timestamp,
-                "index_position": len(self.metadata)  # Position in index
-            }
-            self.metadata.append(metadata_entry)
+            # Add to index (a failed, all-zero embedding is left out; the metadata below is
+            # still stored, so the next load's _reconcile_index embeds it again)
+            if np.any(embedding):
+                if self.index is None:
+                    dim = len(embedding)
+                    self.index = _new_index(dim)
+                    print(f"[conversation_indexer] Created new index with dimension {dim}")
+                self.index.add_with_ids(_normalized(embedding), _id_array([cid]))
+            else:
+                print("[conversation_indexer] Warning: Conversation embedding failed, will retry on next load")
             
-            # Save immediately (Option 1: on-the-fly indexing)
-            self.save_index()
+            # Keep the query-only cache index covering the same conversations (a failed
+            # query embedding is left out and backfilled on the next load)
+            if self._ensure_query_index() and np.any(query_embedding):
+                self._add_query_embedding(query_embedding, cid)
             
-            print(f"[conversation_indexer] ✅ Indexed conversation: {session_id[:20]}...")
+            # Store metadata (appended to the log right away; index files are checkpointed)
+            self.metadata.append(entry)
+            self._id_to_meta[cid] = entry
+            self._append_metadata()
+            self._unsaved += 1
             
-        except Exception as e:
-            print(f"[conversation_indexer] ❌ Error indexing conversation: {e}")
+            if self._unsaved >= CHECKPOINT_EVERY or time.monotonic() - self._last_save_t >= CHECKPOINT_INTERVAL:
+                self.save_index()
+            elif self._flush_timer is None:
+                # Make sure a lone insert still reaches disk soon
+                self._flush_timer = threading.Timer(CHECKPOINT_INTERVAL, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        
+        print(f"[conversation_indexer] ✅ Indexed conversation: {entry['session_id'][:20]}...")
+    
+    def _unused_id(self, cid: int) -> int:
+        """Probe past ids already taken (same session, time and query stored twice)."""
+        while cid in self._id_to_meta:
+            cid = (cid + 1) & 0x7FFF_FFFF_FFFF_FFFF
+        return cid
     
     def search(self, query: str, top_k: int = 5) -> List[Dict]:
         """
@@ -149,27 +816,181 @@ class ConversationIndexer:
         """
         if self.index is None or self.index.ntotal == 0:
             return []
-        
         try:
-            # Get query embedding
-            query_embedding = get_embedding(query).reshape(1, -1)
-            
+            return self._search_embedding(get_query_embedding(query), top_k)
+        except Exception as e:
+            print(f"[conversation_indexer] Error searching conversations: {e}")
+            return []
+    
+    async def asearch(self, query: str, top_k: int = 5) -> List[Dict]:
+        """Async search: the query embedding goes through the shared batcher."""
+        if self.index is None or self.index.ntotal == 0:
+            return []
+        try:
+            query_embedding = await get_query_embedding_async(query)
+            return await asyncio.to_thread(self._search_embedding, query_embedding, top_k)
+        except Exception as e:
+            print(f"[conversation_indexer] Error searching conversations: {e}")
+            return []
+    
+    async def asearch_hits(self, query: str, top_k: int = 5) -> List[SearchHit]:
+        """Like asearch, but returns SearchHits that reference the stored metadata instead of copies."""
+        if self.index is None or self.index.ntotal == 0:
+            return []
+        try:
+            query_embedding = await get_query_embedding_async(query)
+            return await asyncio.to_thread(self._search_hits, query_embedding, top_k)
+        except Exception as e:
+            print(f"[conversation_indexer] Error searching conversations: {e}")
+            return []
+    
+    def _search_embedding(self, query_embedding: np.ndarray, top_k: int) -> List[Dict]:
+        return [
+            {**hit.meta, "similarity_distance": hit.distance}
+            for hit in self._search_hits(query_embedding, top_k)
+        ]
+    
+    def _search_hits(self, query_embedding: np.ndarray, top_k: int) -> List[SearchHit]:
+        with self._lock:
             # Search index
-            distances, indices = self.index.search(query_embedding, min(top_k, self.index.ntotal))
+            distances, indices = self.index.search(self._query_vector(query_embedding), min(top_k, self.index.ntotal))
             
             # Retrieve metadata for matched conversations
-            results = []
-            for i, idx in enumerate(indices[0]):
-                if idx < len(self.metadata):
-                    result = self.metadata[idx].copy()
-                    result["similarity_distance"] = float(distances[0][i])
-                    results.append(result)
+            hits = []
+            for distance, cid in zip(distances[0], indices[0]):
+                meta = self._id_to_meta.get(int(cid))
+                if meta is not None:
+                    hits.append(SearchHit(meta, float(distance)))
+            return hits
+    
+    def _query_vector(self, embedding: np.ndarray) -> np.ndarray:
+        """Normalize embedding into the reusable (1, dim) query buffer. Call with the lock held."""
+        embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        if self._qbuf is None or self._qbuf.shape[1] != embedding.shape[0]:
+            self._qbuf = np.empty((1, embedding.shape[0]), dtype=np.float32)
+        self._qbuf[0] = embedding
+        faiss.normalize_L2(self._qbuf)
+        return self._qbuf
+    
+    def lookup_answer(
+        self,
+        query_embedding: np.ndarray,
+        threshold: float = 0.92,
+        profile: Optional[str] = None,
+        max_age_days: Optional[float] = None,
+        candidates: int = 5
+    ) -> Optional[Dict]:
+        """
+        Semantic cache lookup: nearest stored query by cosine similarity.
+        
+        Args:
+            query_embedding: Embedding of the incoming user query
+            threshold: Minimum cosine similarity for a hit
+            profile: Only serve answers indexed under this agent profile (None disables the check)
+            max_age_days: Ignore answers older than this many days (None disables the check)
+            candidates: Nearest stored queries to consider before giving up
             
-            return results
+        Returns:
+            Copy of the matched conversation metadata (with "similarity"), or None on a miss
+        """
+        if not np.any(query_embedding):
+            return None  # Embedding failed (zero-vector fallback)
+        
+        with self._lock:
+            if not self._ensure_query_index() or self.query_index is None or self.query_index.ntotal == 0:
+                return None
             
+            try:
+                k = min(candidates, self.query_index.ntotal)
+                similarities, indices = self.query_index.search(self._query_vector(query_embedding), k)
+                oldest = datetime.now().timestamp() - max_age_days * 86400 if max_age_days is not None else None
+                
+                for similarity, cid in zip(similarities[0], indices[0]):
+                    similarity = float(similarity)
+                    if similarity < threshold:
+                        break  # Results are sorted, the rest are further away
+                    hit = self._id_to_meta.get(int(cid))
+                    if hit is None:
+                        continue
+                    
+                    if profile is not None and hit.get("profile") != profile:
+                        continue
+                    if oldest is not None and hit.get("timestamp", 0) < oldest:
+                        continue
+                    final_answer = hit.get("final_answer", "")
+                    if not final_answer or any(m in final_answer.lower() for m in UNCACHEABLE_MARKERS):
+                        continue
+                    
+                    result = hit.copy()
+                    result["similarity"] = similarity
+                    return result
+                return None
+                
+            except Exception as e:
+                print(f"[conversation_indexer] Error in semantic cache lookup: {e}")
+                return None
+    
+    def max_query_similarity(self, query_embedding: np.ndarray) -> Optional[float]:
+        """
+        Highest cosine similarity between the query and any stored user query.
+        
+        Returns:
+            Similarity in [-1, 1], 0.0 if nothing is indexed yet, or None if it cannot be computed
+        """
+        if not np.any(query_embedding):
+            return None  # Embedding failed (zero-vector fallback)
+        
+        with self._lock:
+            if not self._ensure_query_index():
+                return None
+            if self.query_index is None or self.query_index.ntotal == 0:
+                return 0.0
+            try:
+                similarities, _ = self.query_index.search(self._query_vector(query_embedding), 1)
+                return float(similarities[0][0])
+            except Exception as e:
+                print(f"[conversation_indexer] Error computing query similarity: {e}")
+                return None
+    
+    def _add_query_embedding(self, query_embedding: np.ndarray, cid: int):
+        vec = _normalized(query_embedding)
+        if self.query_index is None:
+            self.query_index = _new_query_index(vec.shape[1])
+        self.query_index.add_with_ids(vec, _id_array([cid]))
+    
+    def _ensure_query_index(self) -> bool:
+        """
+        Make sure the query index covers every stored conversation (once per load).
+        
+        Only user queries missing from the index are embedded: ones stored before the
+        query index existed, lost with an un-checkpointed query index file, or whose
+        embedding failed. That last kind is retried on the next load, not on every call.
+        """
+        if self._query_index_synced:
+            return True
+        
+        try:
+            indexed = set(faiss.vector_to_array(self.query_index.id_map).tolist()) if self.query_index is not None else set()
+            missing = [entry for entry in self.metadata if entry["cid"] not in indexed]
+            if missing:
+                print(f"[conversation_indexer] Backfilling semantic cache index with {len(missing)} queries")
+                embeddings = get_embeddings([entry.get("user_query", "") for entry in missing])
+                failed = 0
+                for entry, embedding in zip(missing, embeddings):
+                    if np.any(embedding):
+                        self._add_query_embedding(embedding, entry["cid"])
+                    else:
+                        failed += 1  # Failed embedding: not indexed as zeros
+                if failed:
+                    print(f"[conversation_indexer] Warning: {failed} queries could not be embedded, will retry on next load")
+                if failed < len(missing) and not self.read_only:
+                    with self._disk_lock():
+                        _write_index(self.query_index, QUERY_INDEX_FILE)
+            self._query_index_synced = True
+            return True
         except Exception as e:
-            print(f"[conversation_indexer] Error searching conversations: {e}")
-            return []
+            print(f"[conversation_indexer] Error building semantic cache index: {e}")
+            return False
     
     def get_conversation_count(self) -> int:
         """Get total number of indexed conversations."""
@@ -180,13 +1001,23 @@ class ConversationIndexer:
 
 # Global instance
 _conversation_indexer: Optional[ConversationIndexer] = None
+_indexer_lock = threading.Lock()
+_read_only = False
+
+
+def set_read_only(read_only: bool = True):
+    """Open the global indexer read-only in this process (call before the first get_indexer())."""
+    global _read_only
+    _read_only = read_only
 
 
 def get_indexer() -> ConversationIndexer:
     """Get or create global conversation indexer instance."""
     global _conversation_indexer
     if _conversation_indexer is None:
-        _conversation_indexer = ConversationIndexer()
+        with _indexer_lock:
+            if _conversation_indexer is None:
+                _conversation_indexer = ConversationIndexer(read_only=_read_only)
     return _conversation_indexer
 
 
@@ -194,12 +1025,14 @@ def index_conversation(
     session_id: str,
     user_query: str,
     final_answer: str,
-    tool_calls: Optional[List[Dict]] = None,
-    timestamp: Optional[float] = None
+    tool_calls: Optional[List[Union[ToolCallRecord, Dict]]] = None,
+    timestamp: Optional[float] = None,
+    query_embedding: Optional[np.ndarray] = None,
+    profile: Optional[str] = None
 ):
     """Convenience function to index a conversation."""
     indexer = get_indexer()
-    indexer.index_conversation(session_id, user_query, final_answer, tool_calls, timestamp)
+    indexer.index_conversation(session_id, user_query, final_answer, tool_calls, timestamp, query_embedding, profile)
 
 
 def search_conversations(query: str, top_k: int = 5) -> List[Dict]:
@@ -207,3 +1040,29 @@ def search_conversations(query: str, top_k: int = 5) -> List[Dict]:
     indexer = get_indexer()
     return indexer.search(query, top_k)
 
+
+
+async def aindex_conversation(
+    session_id: str,
+    user_query: str,
+    final_answer: str,
+    tool_calls: Optional[List[Union[ToolCallRecord, Dict]]] = None,
+    timestamp: Optional[float] = None,
+    query_embedding: Optional[np.ndarray] = None,
+    profile: Optional[str] = None
+):
+    """Convenience function to index a conversation from async code."""
+    indexer = get_indexer()
+    await indexer.aindex_conversation(session_id, user_query, final_answer, tool_calls, timestamp, query_embedding, profile)
+
+
+async def asearch_conversations(query: str, top_k: int = 5) -> List[Dict]:
+    """Convenience function to search conversations from async code."""
+    indexer = get_indexer()
+    return await indexer.asearch(query, top_k)
+
+
+async def asearch_conversation_hits(query: str, top_k: int = 5) -> List[SearchHit]:
+    """Convenience function to search conversations from async code without copying metadata."""
+    indexer = get_indexer()
+    return await indexer.asearch_hits(query, top_k)
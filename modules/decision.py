@@ -1,7 +1,7 @@
 from typing import List, Optional
 from modules.perception import PerceptionResult
 from modules.memory import MemoryItem
-from modules.model_manager import ModelManager
+from modules.model_manager import get_model_manager
 from modules.tools import load_prompt, extract_python_code_block
 import re
 
@@ -14,7 +14,7 @@ except ImportError:
         now = datetime.datetime.now().strftime("%H:%M:%S")
         print(f"[{now}] [{stage}] {msg}")
 
-model = ModelManager()
+model = get_model_manager()
 
 
 # prompt_path = "prompts/decision_prompt.txt"
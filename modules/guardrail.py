@@ -4,8 +4,25 @@ This module provides safety checks without modifying other scripts.
 """
 
 import re
+import hashlib
 from typing import Tuple, Optional, List
 from dataclasses import dataclass
+from modules.tools import LRUCache
+
+try:
+    import re2  # google-re2: linear-time matching, no catastrophic backtracking
+except ImportError:
+    re2 = None
+
+try:
+    import ahocorasick  # pyahocorasick: all banned words in one pass
+except ImportError:
+    ahocorasick = None
+
+try:
+    import hyperscan  # Intel Hyperscan: one SIMD scan per pattern set
+except ImportError:
+    hyperscan = None
 
 
 @dataclass
@@ -18,95 +35,425 @@ class GuardrailResult:
     reason: Optional[str] = None
 
 
+# Literals a pattern cannot match without. IGNORECASE patterns only list
+# non-letters, so the plain substring check stays valid for them; patterns
+# without such a literal (keyword alternations) are always run.
+_REQUIRED_LITERALS = {
+    # SQL injection
+    r'(\bOR\b|\bAND\b).*=.*': ("=",),
+    r'\'\s*(OR|AND|UNION|SELECT|INSERT|DELETE|DROP|EXEC|EXECUTE)': ("'",),
+    r'(OR|AND|UNION|SELECT|INSERT|DELETE|DROP|EXEC|EXECUTE)\s*\'': ("'",),
+    r'\'\s*=\s*\'': ("'", "="),
+    r'\'\s*OR\s*\'': ("'",),
+    r'\'\s*AND\s*\'': ("'",),
+    r';\s*(--|\/\*)': (";",),
+    r'[=]\s*--': ("=", "--"),
+    r'\/\*.*\*\/': ("/*", "*/"),
+    # Command injection
+    r'`[^`]+`': ("`",),
+    r'\$\([^)]+\)': ("$(", ")"),
+    r';\s*(cat|ls|rm|mv|cp|chmod|sudo|wget|curl)': (";",),
+    # Sensitive paths
+    r'/etc/passwd': ("/",),
+    r'/etc/shadow': ("/",),
+    r'C:\\Windows\\System32': (":\\",),
+    r'\.\.\/\.\.\/': ("../../",),
+    # Encoding
+    r'%[0-9A-Fa-f]{2}': ("%",),
+    r'\\x[0-9A-Fa-f]{2}': ("\\x",),
+    r'\\u[0-9A-Fa-f]{4}': ("\\u",),
+    # Script injection
+    r'<script[^>]*>.*?</script>': ("</",),
+    r'javascript:': (":",),
+    r'onerror\s*=': ("=",),
+    r'onclick\s*=': ("=",),
+}
+
+UNSAFE_DOMAINS = ('malware.com', 'phishing.com')  # Add more as needed
+# One case-insensitive scan per URL, without lowering a copy of it first
+_UNSAFE_DOMAIN_RE = re.compile("|".join(map(re.escape, UNSAFE_DOMAINS)), re.IGNORECASE)
+
+# Replacement for each PII type, applied in _scan_pii (emails keep their domain for
+# context). Plain templates, so re substitutes without calling back into Python
+PII_REPLACEMENTS = {
+    'ssn': '[SSN REDACTED]',
+    'credit_card': '[CARD REDACTED]',
+    'email': r'[EMAIL: \g<domain>]',
+    'phone': '[PHONE REDACTED]',
+}
+
+# Punctuation stripped from a token's edges before matching it against banned words
+BANNED_EDGE_PUNCTUATION = '.,!?;:()[]{}"\''
+
+
+def _compile(pattern: str, flags: int = 0):
+    """
+    Compile a guardrail pattern with RE2 when it is installed, else with re.
+    
+    RE2 guarantees linear-time matching whatever the input, which matters for
+    check_result on documents up to max_result_length. Its \b and \d are
+    ASCII-only; patterns RE2 rejects fall back to re.
+    """
+    if re2 is not None:
+        inline = ("i" if flags & re.IGNORECASE else "") + ("s" if flags & re.DOTALL else "")
+        try:
+            return re2.compile(f"(?{inline}){pattern}" if inline else pattern)
+        except re2.error:
+            pass
+    return re.compile(pattern, flags)
+
+
+def _prefiltered(patterns: List[str], flags: int = 0) -> List[Tuple[Tuple[str, ...], "re.Pattern"]]:
+    """Compile patterns, pairing each with its required literals"""
+    return [(_REQUIRED_LITERALS.get(p, ()), _compile(p, flags)) for p in patterns]
+
+
+# Under re, these two patterns go quadratic on crafted input (every keyword or
+# <script opener rescans the rest of the line/text), so detection uses
+# equivalent linear checks instead
+_OR_AND_RE = re.compile(r'\b(?:OR|AND)\b', re.IGNORECASE)
+_SCRIPT_OPEN_RE = re.compile(r'<script', re.IGNORECASE)
+_SCRIPT_CLOSE_RE = re.compile(r'</script>', re.IGNORECASE)
+
+
+def _or_and_before_equals(text: str) -> bool:
+    """Same as searching (\\bOR\\b|\\bAND\\b).*=.* : a keyword before the last '=' of a line"""
+    for line in text.split("\n"):
+        last_eq = line.rfind("=")
+        if last_eq > 0 and _OR_AND_RE.search(line, 0, last_eq):
+            return True
+    return False
+
+
+def _script_block(text: str) -> bool:
+    """Same as searching <script[^>]*>.*?</script> (DOTALL) in linear time"""
+    # Later openers end at or after the first one's '>', so only the first can matter
+    opener = _SCRIPT_OPEN_RE.search(text)
+    if opener is None:
+        return False
+    tag_end = text.find(">", opener.end())
+    return tag_end != -1 and _SCRIPT_CLOSE_RE.search(text, tag_end + 1) is not None
+
+
+class _AnchoredEmailPattern:
+    """
+    The PII email pattern, matched from each '@' instead of from every position.
+    
+    Under re, a long run of local-part characters is rescanned from each of its
+    positions (quadratic). But every start inside the run reaches the same '@'
+    and the same domain, so only the leftmost word boundary needs one attempt.
+    Gives the same matches as finditer/sub on the full pattern.
+    """
+    
+    LOCAL_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789._%+-")
+    _BOUNDARY_RE = re.compile(r'\b')
+    
+    def __init__(self, compiled):
+        self._compiled = compiled
+    
+    def finditer(self, text: str):
+        last_end = 0
+        at = text.find("@")
+        while at != -1:
+            start = at
+            while start > last_end and text[start - 1] in self.LOCAL_CHARS:
+                start -= 1
+            boundary = self._BOUNDARY_RE.search(text, start, at)
+            if boundary is not None and boundary.start() < at:
+                match = self._compiled.match(text, boundary.start())
+                if match is not None:
+                    yield match
+                    last_end = match.end()
+            at = text.find("@", max(at + 1, last_end))
+    
+    def search(self, text: str):
+        return next(self.finditer(text), None)
+    
+    def subn(self, repl, text: str) -> Tuple[str, int]:
+        parts = []
+        prev = 0
+        for match in self.finditer(text):
+            parts.append(text[prev:match.start()])
+            parts.append(repl(match) if callable(repl) else match.expand(repl))
+            prev = match.end()
+        if not parts:
+            return text, 0
+        count = len(parts) // 2
+        parts.append(text[prev:])
+        return "".join(parts), count
+    
+    def sub(self, repl, text: str) -> str:
+        return self.subn(repl, text)[0]
+
+
+class _HyperscanSet:
+    """
+    One Hyperscan block-mode database over a heuristic's patterns, so detection
+    is a single scan of the text instead of one regex search per pattern.
+    Only used to detect; sanitization still goes through the compiled patterns.
+    """
+    
+    def __init__(self, patterns: List[str], flags: int = 0):
+        hs_flags = hyperscan.HS_FLAG_SINGLEMATCH | hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP
+        if flags & re.IGNORECASE:
+            hs_flags |= hyperscan.HS_FLAG_CASELESS
+        if flags & re.DOTALL:
+            hs_flags |= hyperscan.HS_FLAG_DOTALL
+        self._db = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+        self._db.compile(
+            expressions=[p.encode("utf-8") for p in patterns],
+            ids=list(range(len(patterns))),
+            elements=len(patterns),
+            flags=[hs_flags] * len(patterns),
+        )
+    
+    def matched(self, text: str, first_only: bool = False) -> set:
+        """Indexes of the patterns that match text"""
+        ids = set()
+        
+        def on_match(pattern_id, start, end, flags, context):
+            ids.add(pattern_id)
+            return first_only  # Truthy stops the scan
+        
+        try:
+            self._db.scan(text.encode("utf-8", "surrogatepass"), match_event_handler=on_match)
+        except hyperscan.error:
+            if not (first_only and ids):  # Stopping early surfaces as a scan error
+                raise
+        return ids
+    
+    def search(self, text: str) -> bool:
+        return bool(self.matched(text, first_only=True))
+
+
+def _hyperscan_set(patterns: List[str], flags: int = 0) -> Optional[_HyperscanSet]:
+    """A Hyperscan set for patterns, or None (not installed / unsupported pattern)"""
+    if hyperscan is None:
+        return None
+    try:
+        return _HyperscanSet(patterns, flags)
+    except hyperscan.error as e:
+        print(f"[guardrail] Hyperscan unavailable for pattern set, using re: {e}")
+        return None
+
+
+_LINEAR_SEARCHES = {
+    r'(\bOR\b|\bAND\b).*=.*': _or_and_before_equals,
+    r'<script[^>]*>.*?</script>': _script_block,
+}
+
+
+def _detectors(prefiltered) -> List[Tuple[Tuple[str, ...], callable]]:
+    """Search functions for prefiltered patterns, swapping in the linear checks under re"""
+    return [
+        (literals, _LINEAR_SEARCHES.get(compiled.pattern, compiled.search) if re2 is None else compiled.search)
+        for literals, compiled in prefiltered
+    ]
+
+
+def _may_match(literals: Tuple[str, ...], text: str) -> bool:
+    """Cheap necessary condition for a prefiltered pattern to match text"""
+    # Plain loops, not all()/any() over generators: these run for every pattern on
+    # every check, and for short texts the generator overhead outweighs the scans
+    for literal in literals:
+        if literal not in text:
+            return False
+    return True
+
+
+def _any_match(detectors, text: str) -> bool:
+    """Whether any (literals, search) detector matches text"""
+    for literals, search in detectors:
+        if _may_match(literals, text) and search(text):
+            return True
+    return False
+
+
 class Guardrail:
     """Guardrail system with 10 heuristics for query and result validation"""
     
+    # Heuristic 1: Banned words list
+    banned_words = frozenset({
+        "hack", "exploit", "bypass", "crack", "illegal", 
+        "malware", "virus", "phishing", "scam", "fraud"
+    })
+    
+    # Heuristic 2: Profanity patterns (basic)
+    profanity_patterns = (
+        r'\b(f\*\*k|fuck|f\*\*king|fucking)\b',
+        r'\b(sh\*t|shit|sh\*\*ing|shitting)\b',
+        r'\b(a\*\*hole|asshole|a\*\*)\b',
+        r'\b(b\*\*ch|bitch|b\*\*\*\*)\b',
+        r'\b(damn|hell|bastard|piss|pissed)\b',
+        r'\b(crap|c\*\*p|d\*\*n)\b',
+    )
+    
+    # Heuristic 3: PII patterns
+    pii_patterns = {
+        'ssn': r'\b\d{3}-\d{2}-\d{4}\b',  # SSN: 123-45-6789
+        'credit_card': r'\b\d{4}[\s-]?\d{4}[\s-]?\d{4}[\s-]?\d{4}\b',  # Credit card
+        'email': r'\b(?P<local>[A-Za-z0-9._%+-]+)@(?P<domain>[A-Za-z0-9.-]+\.[A-Z|a-z]{2,})\b',
+        'phone': r'\b\d{3}[-.]?\d{3}[-.]?\d{4}\b',  # US phone
+    }
+    
+    # Heuristic 4: SQL injection patterns
+    # More specific patterns to avoid false positives with normal apostrophes
+    sql_injection_patterns = (
+        r'(\bOR\b|\bAND\b).*=.*',
+        r'(\bUNION\b|\bSELECT\b|\bINSERT\b|\bDELETE\b|\bDROP\b)',
+        # Only match quotes in SQL injection contexts, not standalone apostrophes
+        r'\'\s*(OR|AND|UNION|SELECT|INSERT|DELETE|DROP|EXEC|EXECUTE)',
+        r'(OR|AND|UNION|SELECT|INSERT|DELETE|DROP|EXEC|EXECUTE)\s*\'',
+        r'\'\s*=\s*\'',  # Pattern like '=' (SQL injection)
+        r'\'\s*OR\s*\'',  # Pattern like ' OR ' (SQL injection)
+        r'\'\s*AND\s*\'',  # Pattern like ' AND ' (SQL injection)
+        r';\s*(--|\/\*)',  # Semicolon followed by SQL comment
+        r'[=]\s*--',  # Equal sign followed by SQL comment
+        r'\/\*.*\*\/',  # SQL block comment
+        r'(\bEXEC\b|\bEXECUTE\b)',
+    )
+    
+    # Heuristic 5: Command injection patterns (more specific to avoid false positives)
+    command_injection_patterns = (
+        r'[;&|`]\s*\w+',  # Shell metacharacters followed by word (command-like)
+        r'\b(cat|ls|rm|mv|cp|chmod|sudo)\s+',  # Common shell commands
+        r'(\|\||&&)',  # Command chaining operators
+        r'`[^`]+`',  # Backtick command execution
+        r'\$\([^)]+\)',  # Command substitution $(...)
+        r';\s*(cat|ls|rm|mv|cp|chmod|sudo|wget|curl)',  # Semicolon followed by command
+    )
+    
+    # Heuristic 6: URL validation patterns
+    url_pattern = re.compile(
+        r'https?://[^\s<>"{}|\\^`\[\]]+',
+        re.IGNORECASE
+    )
+    
+    # Heuristic 7: Sensitive file paths
+    sensitive_paths = (
+        r'/etc/passwd',
+        r'/etc/shadow',
+        r'C:\\Windows\\System32',
+        r'\.\.\/\.\.\/',  # Path traversal
+    )
+    
+    # Heuristic 8: Max length limits
+    max_query_length = 10000
+    max_result_length = 50000
+    # Results are scanned this far past max_result_length, so a match straddling the cut
+    # (e.g. an email) is still redacted before truncation; no PII match is anywhere near
+    # half this long. Redactions and whitespace collapsing can shrink the scanned text,
+    # so if less than half the slack is left the whole result is scanned instead.
+    result_scan_slack = 4096
+    
+    # Heuristic 9: Suspicious encoding patterns
+    encoding_patterns = (
+        r'%[0-9A-Fa-f]{2}',  # URL encoding
+        r'\\x[0-9A-Fa-f]{2}',  # Hex encoding
+        r'\\u[0-9A-Fa-f]{4}',  # Unicode encoding
+    )
+    
+    # Heuristic 10: Suspicious script tags/HTML injection
+    script_patterns = (
+        r'<script[^>]*>.*?</script>',
+        r'javascript:',
+        r'onerror\s*=',
+        r'onclick\s*=',
+    )
+    
+    # Compiled once, when the class is defined, and shared by every instance.
+    # Profanity alternatives all start with \b, so they are fused into a single
+    # scan; the other heuristics keep one compiled pattern each, since fusing them
+    # defeats re's literal-prefix search on long results. Instead, each pattern is
+    # paired with the literals it cannot match without (see _REQUIRED_LITERALS),
+    # and is only run once a cheap substring check finds all of them in the text.
+    _profanity_any = _compile(
+        "|".join(f"(?:{p})" for p in profanity_patterns), re.IGNORECASE
+    )
+    _profanity_res = [_compile(p, re.IGNORECASE) for p in profanity_patterns]
+    _pii_res = {name: _compile(p) for name, p in pii_patterns.items()}
+    if re2 is None:
+        _pii_res['email'] = _AnchoredEmailPattern(_pii_res['email'])
+    _banned_automaton = None
+    if ahocorasick is not None:
+        _banned_automaton = ahocorasick.Automaton()
+        for _word in banned_words:
+            _banned_automaton.add_word(_word, _word)
+        _banned_automaton.make_automaton()
+        del _word
+    # Every PII pattern needs a digit (SSN, card, phone) or an '@' (email)
+    _pii_trigger = re.compile(r'[\d@]')
+    _sql_res = _prefiltered(sql_injection_patterns, re.IGNORECASE)
+    _sql_detect = _detectors(_sql_res)
+    _sql_hs = _hyperscan_set(sql_injection_patterns, re.IGNORECASE)
+    # Detection is case-insensitive, sanitization (as before) is not. The bare
+    # metacharacter pattern is the only one URLs can trip on its own
+    _command_res = [
+        (_REQUIRED_LITERALS.get(p, ()), _compile(p, re.IGNORECASE), p == r'[;&|`]\s*\w+')
+        for p in command_injection_patterns
+    ]
+    _command_sub_res = _prefiltered(command_injection_patterns)
+    _command_hs = _hyperscan_set(command_injection_patterns, re.IGNORECASE)
+    _path_res = _prefiltered(sensitive_paths, re.IGNORECASE)
+    _path_detect = _detectors(_path_res)
+    _path_hs = _hyperscan_set(sensitive_paths, re.IGNORECASE)
+    _encoding_res = _prefiltered(encoding_patterns)
+    _script_res = _prefiltered(script_patterns, re.IGNORECASE | re.DOTALL)
+    _script_detect = _detectors(_script_res)
+    _script_hs = _hyperscan_set(script_patterns, re.IGNORECASE | re.DOTALL)
+    # When Hyperscan is installed each *_hs set replaces the per-pattern searches
+    _profanity_hs = _hyperscan_set(profanity_patterns, re.IGNORECASE)
+    
     def __init__(self):
-        # Heuristic 1: Banned words list
-        self.banned_words = {
-            "hack", "exploit", "bypass", "crack", "illegal", 
-            "malware", "virus", "phishing", "scam", "fraud"
-        }
-        
-        # Heuristic 2: Profanity patterns (basic)
-        self.profanity_patterns = [
-            r'\b(f\*\*k|fuck|f\*\*king|fucking)\b',
-            r'\b(sh\*t|shit|sh\*\*ing|shitting)\b',
-            r'\b(a\*\*hole|asshole|a\*\*)\b',
-            r'\b(b\*\*ch|bitch|b\*\*\*\*)\b',
-            r'\b(damn|hell|bastard|piss|pissed)\b',
-            r'\b(crap|c\*\*p|d\*\*n)\b',
-        ]
-        
-        # Heuristic 3: PII patterns
-        self.pii_patterns = {
-            'ssn': r'\b\d{3}-\d{2}-\d{4}\b',  # SSN: 123-45-6789
-            'credit_card': r'\b\d{4}[\s-]?\d{4}[\s-]?\d{4}[\s-]?\d{4}\b',  # Credit card
-            'email': r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b',
-            'phone': r'\b\d{3}[-.]?\d{3}[-.]?\d{4}\b',  # US phone
-        }
-        
-        # Heuristic 4: SQL injection patterns
-        # More specific patterns to avoid false positives with normal apostrophes
-        self.sql_injection_patterns = [
-            r'(\bOR\b|\bAND\b).*=.*',
-            r'(\bUNION\b|\bSELECT\b|\bINSERT\b|\bDELETE\b|\bDROP\b)',
-            # Only match quotes in SQL injection contexts, not standalone apostrophes
-            r'\'\s*(OR|AND|UNION|SELECT|INSERT|DELETE|DROP|EXEC|EXECUTE)',
-            r'(OR|AND|UNION|SELECT|INSERT|DELETE|DROP|EXEC|EXECUTE)\s*\'',
-            r'\'\s*=\s*\'',  # Pattern like '=' (SQL injection)
-            r'\'\s*OR\s*\'',  # Pattern like ' OR ' (SQL injection)
-            r'\'\s*AND\s*\'',  # Pattern like ' AND ' (SQL injection)
-            r';\s*(--|\/\*)',  # Semicolon followed by SQL comment
-            r'[=]\s*--',  # Equal sign followed by SQL comment
-            r'\/\*.*\*\/',  # SQL block comment
-            r'(\bEXEC\b|\bEXECUTE\b)',
-        ]
-        
-        # Heuristic 5: Command injection patterns (more specific to avoid false positives)
-        self.command_injection_patterns = [
-            r'[;&|`]\s*\w+',  # Shell metacharacters followed by word (command-like)
-            r'\b(cat|ls|rm|mv|cp|chmod|sudo)\s+',  # Common shell commands
-            r'(\|\||&&)',  # Command chaining operators
-            r'`[^`]+`',  # Backtick command execution
-            r'\$\([^)]+\)',  # Command substitution $(...)
-            r';\s*(cat|ls|rm|mv|cp|chmod|sudo|wget|curl)',  # Semicolon followed by command
-        ]
-        
-        # Heuristic 6: URL validation patterns
-        self.url_pattern = re.compile(
-            r'https?://[^\s<>"{}|\\^`\[\]]+',
-            re.IGNORECASE
-        )
-        
-        # Heuristic 7: Sensitive file paths
-        self.sensitive_paths = [
-            r'/etc/passwd',
-            r'/etc/shadow',
-            r'C:\\Windows\\System32',
-            r'\.\.\/\.\.\/',  # Path traversal
-        ]
-        
-        # Heuristic 8: Max length limits
-        self.max_query_length = 10000
-        self.max_result_length = 50000
-        
-        # Heuristic 9: Suspicious encoding patterns
-        self.encoding_patterns = [
-            r'%[0-9A-Fa-f]{2}',  # URL encoding
-            r'\\x[0-9A-Fa-f]{2}',  # Hex encoding
-            r'\\u[0-9A-Fa-f]{4}',  # Unicode encoding
-        ]
-        
-        # Heuristic 10: Suspicious script tags/HTML injection
-        self.script_patterns = [
-            r'<script[^>]*>.*?</script>',
-            r'javascript:',
-            r'onerror\s*=',
-            r'onclick\s*=',
-        ]
+        # Results are pure over their input, and the agent re-checks the same
+        # strings (retries, repeated answers): keep the last few, LRU-evicted
+        self._result_cache = LRUCache(1024)
     
     def check_query(self, query: str) -> GuardrailResult:
+        """
+        Apply all guardrail heuristics to a user query (memoized).
+        
+        Args:
+            query: The user's input query
+            
+        Returns:
+            GuardrailResult with sanitized content and warnings
+        """
+        return self._cached("query", query, self._check_query_impl)
+    
+    def check_result(self, result: str) -> GuardrailResult:
+        """
+        Apply all guardrail heuristics to a result/output (memoized).
+        
+        Args:
+            result: The result/output to check
+            
+        Returns:
+            GuardrailResult with sanitized content and warnings
+        """
+        return self._cached("result", result, self._check_result_impl)
+    
+    def _cached(self, kind: str, text: str, check) -> GuardrailResult:
+        """Serve a check from the LRU cache, running it on a miss"""
+        # Long texts are keyed by digest so the cache doesn't pin large results in memory
+        if len(text) > self.max_query_length:
+            key = (kind, len(text), hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest())
+        else:
+            key = (kind, len(text), text)
+        cached = self._result_cache.get(key)
+        if cached is None:
+            cached = check(text)
+            self._result_cache.put(key, cached)
+        # Hand out a copy: callers may mutate the warnings list
+        return GuardrailResult(
+            passed=cached.passed,
+            sanitized_content=cached.sanitized_content,
+            warnings=list(cached.warnings),
+            blocked=cached.blocked,
+            reason=cached.reason
+        )
+    
+    def _check_query_impl(self, query: str) -> GuardrailResult:
         """
         Apply all guardrail heuristics to a user query.
         
@@ -133,11 +480,9 @@ class Guardrail:
             sanitized = self._sanitize_profanity(sanitized)
         
         # Heuristic 3: Check for PII in query (shouldn't be there, but check)
-        pii_found = self._detect_pii(sanitized)
+        sanitized, pii_found = self._scan_pii(sanitized)
         if pii_found:
             warnings.append(f"Potential PII detected in query: {', '.join(pii_found)}")
-            # Sanitize PII
-            sanitized = self._sanitize_pii(sanitized)
         
         # Heuristic 4: Check for SQL injection patterns
         if self._contains_sql_injection(sanitized):
@@ -187,7 +532,7 @@ class Guardrail:
             reason=reason
         )
     
-    def check_result(self, result: str) -> GuardrailResult:
+    def _check_result_impl(self, result: str) -> GuardrailResult:
         """
         Apply all guardrail heuristics to a result/output.
         
@@ -197,11 +542,46 @@ class Guardrail:
         Returns:
             GuardrailResult with sanitized content and warnings
         """
-        warnings = []
-        sanitized = result
         blocked = False
         reason = None
         
+        # Only the first max_result_length chars of the sanitized text are returned, so
+        # large documents are scanned up to there plus slack rather than (ten times) in full
+        truncated = len(result) > self.max_result_length
+        scan_limit = self.max_result_length + self.result_scan_slack
+        sanitized, warnings = self._scan_result_body(result[:scan_limit])
+        if len(result) > scan_limit and len(sanitized) < self.max_result_length + self.result_scan_slack // 2:
+            # Heuristics 1-7 shrank the prefix enough that its cut could reach the returned text
+            sanitized, warnings = self._scan_result_body(result)
+        
+        # Heuristic 8: Check result length
+        if truncated:
+            warnings.append(f"Result exceeds maximum length ({self.max_result_length} chars)")
+            sanitized = sanitized[:self.max_result_length] + "... [truncated]"
+        
+        # Heuristic 9: Check for suspicious encoding in results
+        if self._contains_suspicious_encoding(sanitized):
+            warnings.append("Suspicious encoding patterns detected in result")
+            sanitized = self._decode_suspicious_encoding(sanitized)
+        
+        # Heuristic 10: Check for script injection in results
+        # Only warn, don't block - document content may contain script-like patterns in code examples
+        if self._contains_script_injection(sanitized):
+            warnings.append("Script injection pattern detected in result (may be false positive in document content)")
+            # Don't block or sanitize results - document content may legitimately contain script examples
+        
+        return GuardrailResult(
+            passed=not blocked,
+            sanitized_content=sanitized,
+            warnings=warnings,
+            blocked=blocked,
+            reason=reason
+        )
+    
+    def _scan_result_body(self, sanitized: str) -> Tuple[str, List[str]]:
+        """Heuristics 1-7 of check_result: the sanitized text and the warnings raised"""
+        warnings = []
+        
         # Heuristic 1: Remove banned words from results
         sanitized, banned_found = self._remove_banned_words(sanitized)
         if banned_found:
@@ -213,11 +593,14 @@ class Guardrail:
             sanitized = self._sanitize_profanity(sanitized)
         
         # Heuristic 3: Check for PII in results (critical!)
-        pii_found = self._detect_pii(sanitized)
+        sanitized, pii_found = self._scan_pii(sanitized)
         if pii_found:
+            # PII in results is always sanitized
             warnings.append(f"PII detected in result: {', '.join(pii_found)}")
-            # Always sanitize PII in results
-            sanitized = self._sanitize_pii(sanitized)
+        
+        # Heuristics 4, 5 and 10 only warn here, but they stay serial rather than on a
+        # thread pool: CPython's re holds the GIL while matching, so threads would just
+        # take turns (plus hand-off cost). Input size is bounded by the scan limit.
         
         # Heuristic 4: Check for SQL injection in results
         # Only warn, don't sanitize - results often contain false positives (e.g., "European Union")
@@ -243,40 +626,61 @@ class Guardrail:
             warnings.append("Sensitive file path detected in result")
             sanitized = self._sanitize_paths(sanitized)
         
-        # Heuristic 8: Check result length
-        if len(result) > self.max_result_length:
-            warnings.append(f"Result exceeds maximum length ({self.max_result_length} chars)")
-            sanitized = sanitized[:self.max_result_length] + "... [truncated]"
-        
-        # Heuristic 9: Check for suspicious encoding in results
-        if self._contains_suspicious_encoding(sanitized):
-            warnings.append("Suspicious encoding patterns detected in result")
-            sanitized = self._decode_suspicious_encoding(sanitized)
-        
-        # Heuristic 10: Check for script injection in results
-        # Only warn, don't block - document content may contain script-like patterns in code examples
-        if self._contains_script_injection(sanitized):
-            warnings.append("Script injection pattern detected in result (may be false positive in document content)")
-            # Don't block or sanitize results - document content may legitimately contain script examples
-        
-        return GuardrailResult(
-            passed=not blocked,
-            sanitized_content=sanitized,
-            warnings=warnings,
-            blocked=blocked,
-            reason=reason
-        )
+        return sanitized, warnings
     
     # Helper methods for each heuristic
     
     def _remove_banned_words(self, text: str) -> Tuple[str, bool]:
         """Heuristic 1: Remove banned words"""
+        # Whitespace is collapsed to single spaces, as the later heuristics
+        # (e.g. the line-bound SQL patterns) have always seen the joined text
+        joined = ' '.join(text.split())
+        lowered = joined.lower()
+        if len(lowered) != len(joined):
+            # Case folding grew the text, so offsets no longer line up: walk the tokens
+            return self._remove_banned_tokens(joined)
+        
+        # Only tokens containing a banned word can be banned: find those with
+        # C-level literal search instead of lowering/stripping every token
+        spans = set()
+        for i in self._banned_word_hits(lowered):
+            start = lowered.rfind(' ', 0, i) + 1
+            end = lowered.find(' ', i)
+            if end == -1:
+                end = len(lowered)
+            if lowered[start:end].strip(BANNED_EDGE_PUNCTUATION) in self.banned_words:
+                spans.add((start, end))
+        if not spans:
+            return joined, False
+        
+        parts = []
+        prev = 0
+        for start, end in sorted(spans):
+            parts.append(joined[prev:start])
+            parts.append("[REDACTED]")
+            prev = end
+        parts.append(joined[prev:])
+        return ''.join(parts), True
+    
+    def _banned_word_hits(self, lowered: str):
+        """Start offsets of banned-word occurrences in lowered text"""
+        if self._banned_automaton is not None:
+            # One Aho-Corasick pass finds every word at once (yields end offsets)
+            for end, word in self._banned_automaton.iter(lowered):
+                yield end - len(word) + 1
+            return
+        for banned in self.banned_words:
+            i = lowered.find(banned)
+            while i != -1:
+                yield i
+                i = lowered.find(banned, i + len(banned))
+    
+    def _remove_banned_tokens(self, text: str) -> Tuple[str, bool]:
+        """Token-by-token banned word removal (fallback for _remove_banned_words)"""
         found = False
-        words = text.split()
         sanitized_words = []
-        for word in words:
-            word_lower = word.lower().strip('.,!?;:()[]{}"\'')
-            if word_lower in self.banned_words:
+        for word in text.split():
+            if word.lower().strip(BANNED_EDGE_PUNCTUATION) in self.banned_words:
                 found = True
                 sanitized_words.append("[REDACTED]")
             else:
@@ -285,107 +689,108 @@ class Guardrail:
     
     def _contains_profanity(self, text: str) -> bool:
         """Heuristic 2: Check for profanity"""
-        for pattern in self.profanity_patterns:
-            if re.search(pattern, text, re.IGNORECASE):
-                return True
-        return False
+        if self._profanity_hs is not None:
+            return self._profanity_hs.search(text)
+        return self._profanity_any.search(text) is not None
     
     def _sanitize_profanity(self, text: str) -> str:
         """Sanitize profanity"""
-        for pattern in self.profanity_patterns:
-            text = re.sub(pattern, "[REDACTED]", text, flags=re.IGNORECASE)
+        for pattern in self._profanity_res:
+            text = pattern.sub("[REDACTED]", text)
         return text
     
-    def _detect_pii(self, text: str) -> List[str]:
-        """Heuristic 3: Detect PII"""
+    def _scan_pii(self, text: str) -> Tuple[str, List[str]]:
+        """Heuristic 3: Detect and sanitize PII, one subn pass per type"""
         found = []
-        for pii_type, pattern in self.pii_patterns.items():
-            if re.search(pattern, text):
+        # Fail fast: most text has neither digits nor '@', so skip the four PII scans
+        if not self._pii_trigger.search(text):
+            return text, found
+        # Types are redacted in order (SSN, card, email, phone) but detected on the text
+        # as it came in, so overlapping matches still get their own warning
+        original = text
+        redacted = False
+        for pii_type, pattern in self._pii_res.items():
+            text, count = pattern.subn(PII_REPLACEMENTS[pii_type], text)
+            # Until something is redacted the text is the original, and the count decides
+            if (pattern.search(original) is not None) if redacted else count:
                 found.append(pii_type.upper())
-        return found
-    
-    def _sanitize_pii(self, text: str) -> str:
-        """Sanitize PII"""
-        # Replace SSN
-        text = re.sub(self.pii_patterns['ssn'], '[SSN REDACTED]', text)
-        # Replace credit cards
-        text = re.sub(self.pii_patterns['credit_card'], '[CARD REDACTED]', text)
-        # Replace emails (keep domain for context)
-        text = re.sub(
-            self.pii_patterns['email'],
-            lambda m: f'[EMAIL: {m.group().split("@")[1]}]',
-            text
-        )
-        # Replace phone numbers
-        text = re.sub(self.pii_patterns['phone'], '[PHONE REDACTED]', text)
-        return text
+            redacted = redacted or count > 0
+        return text, found
     
     def _contains_sql_injection(self, text: str) -> bool:
         """Heuristic 4: Check for SQL injection"""
-        for pattern in self.sql_injection_patterns:
-            if re.search(pattern, text, re.IGNORECASE):
-                return True
-        return False
+        if self._sql_hs is not None:
+            return self._sql_hs.search(text)
+        return _any_match(self._sql_detect, text)
     
     def _sanitize_sql_injection(self, text: str) -> str:
         """Sanitize SQL injection patterns"""
-        for pattern in self.sql_injection_patterns:
-            text = re.sub(pattern, '[SQL PATTERN REMOVED]', text, flags=re.IGNORECASE)
+        for literals, pattern in self._sql_res:
+            if _may_match(literals, text):
+                text = pattern.sub('[SQL PATTERN REMOVED]', text)
         return text
     
     def _contains_command_injection(self, text: str) -> bool:
         """Heuristic 5: Check for command injection (more lenient for URLs and search results)"""
-        # If text contains URLs, be more lenient (URLs often have special chars)
-        has_urls = bool(self.url_pattern.search(text))
+        if self._command_hs is not None:
+            matched = self._command_hs.matched(text)
+            if any(not self._command_res[i][2] for i in matched):
+                return True
+            # Only the URL-lenient pattern matched
+            return bool(matched) and not self.url_pattern.search(text)
         
         # Check for command injection patterns
-        for pattern in self.command_injection_patterns:
-            if re.search(pattern, text, re.IGNORECASE):
-                # If URLs are present, only block if it's clearly a command (not just URL chars)
-                if has_urls:
-                    # These patterns are actual command patterns, block them even with URLs
-                    if pattern in [r'\b(cat|ls|rm|mv|cp|chmod|sudo)\s+', r'(\|\||&&)', r'`[^`]+`', r'\$\([^)]+\)', r';\s*(cat|ls|rm|mv|cp|chmod|sudo|wget|curl)']:
-                        return True
-                    # Pattern like `[;&|`]\s*\w+` might match URL chars, skip if URLs present
-                    if pattern == r'[;&|`]\s*\w+':
-                        continue
+        for literals, compiled, url_lenient in self._command_res:
+            if _may_match(literals, text) and compiled.search(text):
+                # Pattern like `[;&|`]\s*\w+` might match URL chars, skip it if URLs are present
+                # (URLs often have special chars); the others are actual command patterns
+                # and block even with URLs. The URL scan only runs once something matched
+                if url_lenient and self.url_pattern.search(text):
+                    continue
                 return True
         return False
     
     def _sanitize_command_injection(self, text: str) -> str:
         """Sanitize command injection patterns"""
-        for pattern in self.command_injection_patterns:
-            text = re.sub(pattern, '[COMMAND PATTERN REMOVED]', text)
+        for literals, pattern in self._command_sub_res:
+            if _may_match(literals, text):
+                text = pattern.sub('[COMMAND PATTERN REMOVED]', text)
         return text
     
     def _extract_urls(self, text: str) -> List[str]:
         """Heuristic 6: Extract URLs"""
+        if "://" not in text:
+            return []
         return self.url_pattern.findall(text)
     
     def _is_safe_url(self, url: str) -> bool:
         """Check if URL is safe"""
-        unsafe_domains = ['malware.com', 'phishing.com']  # Add more as needed
-        url_lower = url.lower()
-        return not any(domain in url_lower for domain in unsafe_domains)
+        return _UNSAFE_DOMAIN_RE.search(url) is None
     
     def _contains_sensitive_paths(self, text: str) -> bool:
         """Heuristic 7: Check for sensitive file paths"""
-        for pattern in self.sensitive_paths:
-            if re.search(pattern, text, re.IGNORECASE):
-                return True
-        return False
+        if self._path_hs is not None:
+            return self._path_hs.search(text)
+        return _any_match(self._path_detect, text)
     
     def _sanitize_paths(self, text: str) -> str:
         """Sanitize sensitive paths"""
-        for pattern in self.sensitive_paths:
-            text = re.sub(pattern, '[PATH REDACTED]', text, flags=re.IGNORECASE)
+        for literals, pattern in self._path_res:
+            if _may_match(literals, text):
+                text = pattern.sub('[PATH REDACTED]', text)
         return text
     
     def _contains_suspicious_encoding(self, text: str) -> bool:
         """Heuristic 9: Check for suspicious encoding"""
-        for pattern in self.encoding_patterns:
-            if len(re.findall(pattern, text)) > 5:  # Threshold
-                return True
+        for literals, pattern in self._encoding_res:
+            if not _may_match(literals, text):
+                continue
+            # Stop scanning as soon as the threshold is exceeded
+            count = 0
+            for _ in pattern.finditer(text):
+                count += 1
+                if count > 5:  # Threshold
+                    return True
         return False
     
     def _decode_suspicious_encoding(self, text: str) -> str:
@@ -396,15 +801,15 @@ class Guardrail:
     
     def _contains_script_injection(self, text: str) -> bool:
         """Heuristic 10: Check for script injection"""
-        for pattern in self.script_patterns:
-            if re.search(pattern, text, re.IGNORECASE | re.DOTALL):
-                return True
-        return False
+        if self._script_hs is not None:
+            return self._script_hs.search(text)
+        return _any_match(self._script_detect, text)
     
     def _sanitize_scripts(self, text: str) -> str:
         """Sanitize script tags"""
-        for pattern in self.script_patterns:
-            text = re.sub(pattern, '[SCRIPT REMOVED]', text, flags=re.IGNORECASE | re.DOTALL)
+        for literals, pattern in self._script_res:
+            if _may_match(literals, text):
+                text = pattern.sub('[SCRIPT REMOVED]', text)
         return text
 
 
@@ -3,8 +3,12 @@ Historical conversation pre-check layer.
 Before running the full agent loop, check if the answer is already in historical conversations.
 """
 
-import json
-from modules.model_manager import ModelManager
+import asyncio
+import re
+import textwrap
+from modules.model_manager import get_model_manager
+from core.config import load_profile
+from modules.tools import loads_json
 
 try:
     from agent import log
@@ -14,19 +18,55 @@ except ImportError:
         now = datetime.datetime.now().strftime("%H:%M:%S")
         print(f"[{now}] [{stage}] {msg}")
 
-model = ModelManager()
-
-async def check_historical_conversations(user_input: str, mcp_dispatcher) -> dict:
+# Phrases in a HAS_CONTEXT summary that mean the history doesn't actually answer
+# the query; one case-insensitive scan instead of lowering and N substring tests
+NEGATIVE_INDICATORS = [
+    "do not provide",
+    "does not provide",
+    "does not contain",
+    "not provide",
+    "not contain",
+    "no information",
+    "no relevant",
+    "completely unrelated",
+    "unrelated",
+    "not relevant"
+]
+_NEGATIVE_INDICATORS_RE = re.compile("|".join(map(re.escape, NEGATIVE_INDICATORS)), re.IGNORECASE)
+
+# Payloads above this size are parsed in a worker thread rather than on the event loop
+OFFLOOP_PARSE_CHARS = 64 * 1024
+
+# Stored answers that are error markers rather than real answers
+_ERROR_ANSWER_RE = re.compile(r'\[max steps reached\]|\[result blocked|\[error', re.IGNORECASE)
+
+async def check_historical_conversations(user_input: str, mcp_dispatcher, query_embedding=None) -> dict:
     """
     Pre-check layer: Search historical conversations and use LLM to determine
     if the answer can be found directly without tools.
     
+    Args:
+        user_input: Query to check against history
+        mcp_dispatcher: MultiMCP used to reach the memory server
+        query_embedding: Embedding of user_input; when given, queries with no
+            similar stored query skip the search and LLM round-trip entirely
+    
     Returns:
         - {"can_answer": True, "answer": "FINAL_ANSWER: ..."} if answer found completely
         - {"can_answer": False, "has_context": True, "context": "..."} if has relevant context but needs tools
         - {"can_answer": False, "has_context": False} if no relevant context, needs fresh approach
     """
     try:
+        # Step 0: Cheap similarity gate - novel queries can't be answered from history
+        if query_embedding is not None:
+            floor = load_profile().get("memory", {}).get("historical_similarity_floor", 0.0)
+            from modules.conversation_indexer import get_indexer  # Deferred: pulls in FAISS
+            max_similarity = await asyncio.to_thread(get_indexer().max_query_similarity, query_embedding)
+            if max_similarity is not None and max_similarity < floor:
+                _print_path_box("FRESH_APPROACH", f"No similar past query (best similarity {max_similarity:.2f}) - proceeding with traditional route")
+                log("historical_check", f"⏭️ Best historical similarity {max_similarity:.2f} below floor {floor} - skipping LLM check")
+                return {"can_answer": False, "has_context": False}
+        
         # Step 1: Search historical conversations
         log("historical_check", "🔍 Checking historical conversations for direct answer...")
         
@@ -40,9 +80,14 @@ async def check_historical_conversations(user_input: str, mcp_dispatcher) -> dic
             log("historical_check", "⚠️ No historical conversations found")
             return {"can_answer": False}
         
-        # Parse historical data
+        # Parse historical data (large payloads are decoded off the event loop)
         try:
-            historical_data = json.loads(historical_result.content[0].text).get("result", [])
+            payload = historical_result.content[0].text
+            if len(payload) > OFFLOOP_PARSE_CHARS:
+                parsed = await asyncio.to_thread(loads_json, payload)
+            else:
+                parsed = loads_json(payload)
+            historical_data = parsed.get("result", [])
         except Exception as e:
             log("historical_check", f"⚠️ Could not parse historical conversations: {e}")
             return {"can_answer": False}
@@ -58,7 +103,7 @@ async def check_historical_conversations(user_input: str, mcp_dispatcher) -> dic
             final_answer = conv.get("final_answer", "")
             
             # Skip error messages
-            if any(err in final_answer.lower() for err in ["[max steps reached]", "[result blocked", "[error"]):
+            if _ERROR_ANSWER_RE.search(final_answer):
                 continue
                 
             context_items.append(
@@ -110,7 +155,7 @@ Examples:
 
 Now analyze the question and respond:"""
         
-        llm_response = await model.generate_text(decision_prompt)
+        llm_response = await get_model_manager().generate_text(decision_prompt)
         llm_response = llm_response.strip()
         
         # Step 4: Check LLM decision
@@ -123,21 +168,7 @@ Now analyze the question and respond:"""
             context_summary = llm_response.replace("HAS_CONTEXT:", "").strip()
             
             # ❗STRICT CHECK: If context summary explicitly says context doesn't contain the answer, treat as NO_CONTEXT
-            context_lower = context_summary.lower()
-            negative_indicators = [
-                "do not provide",
-                "does not provide",
-                "does not contain",
-                "not provide",
-                "not contain",
-                "no information",
-                "no relevant",
-                "completely unrelated",
-                "unrelated",
-                "not relevant"
-            ]
-            
-            if any(indicator in context_lower for indicator in negative_indicators):
+            if _NEGATIVE_INDICATORS_RE.search(context_summary):
                 _print_path_box("FRESH_APPROACH", "Historical context found but not relevant to query - proceeding with traditional route", context_summary)
                 log("historical_check", f"⚠️ Context summary indicates irrelevant context: {context_summary[:100]}... - treating as NO_CONTEXT")
                 return {"can_answer": False, "has_context": False}
@@ -157,49 +188,37 @@ Now analyze the question and respond:"""
 def _print_path_box(path_type: str, description: str, context: str = None):
     """Print a nice box showing which path was chosen."""
     width = 70
-    print("\n" + "═" * width)
-    print("║" + " " * (width - 2) + "║")
+    horizontal = "═" * width
+    empty = "║" + " " * (width - 2) + "║"
+    rule = "║" + "─" * (width - 2) + "║"
+    lines = ["\n" + horizontal, empty]
     
     # Path type
     path_text = f"PATH: {path_type}"
     padding = (width - 2 - len(path_text)) // 2
-    print("║" + " " * padding + path_text + " " * (width - 2 - padding - len(path_text)) + "║")
-    print("║" + " " * (width - 2) + "║")
+    lines.append("║" + " " * padding + path_text + " " * (width - 2 - padding - len(path_text)) + "║")
+    lines.append(empty)
     
     # Description
-    desc_lines = _wrap_text(description, width - 4)
-    for line in desc_lines:
-        print("║ " + line.ljust(width - 4) + " ║")
-    print("║" + " " * (width - 2) + "║")
+    for line in _wrap_text(description, width - 4):
+        lines.append("║ " + line.ljust(width - 4) + " ║")
+    lines.append(empty)
     
     # Context if provided
     if context:
-        print("║" + "─" * (width - 2) + "║")
-        print("║ " + "CONTEXT TAKEN FORWARD:".ljust(width - 4) + " ║")
-        print("║" + "─" * (width - 2) + "║")
-        context_lines = _wrap_text(context, width - 4)
-        for line in context_lines:
-            print("║ " + line.ljust(width - 4) + " ║")
+        lines.append(rule)
+        lines.append("║ " + "CONTEXT TAKEN FORWARD:".ljust(width - 4) + " ║")
+        lines.append(rule)
+        for line in _wrap_text(context, width - 4):
+            lines.append("║ " + line.ljust(width - 4) + " ║")
     
-    print("║" + " " * (width - 2) + "║")
-    print("═" * width + "\n")
+    lines.append(empty)
+    lines.append(horizontal + "\n")
+    # One write for the whole box
+    print("\n".join(lines))
 
 def _wrap_text(text: str, max_width: int) -> list:
     """Wrap text to fit within max_width."""
-    words = text.split()
-    lines = []
-    current_line = ""
-    
-    for word in words:
-        if len(current_line) + len(word) + 1 <= max_width:
-            current_line += (word + " ") if current_line else word
-        else:
-            if current_line:
-                lines.append(current_line.rstrip())
-            current_line = word + " "
-    
-    if current_line:
-        lines.append(current_line.rstrip())
-    
-    return lines if lines else [""]
+    # Long words (URLs, ids) stay whole and overflow, as they always have
+    return textwrap.wrap(text, max_width, break_long_words=False, break_on_hyphens=False) or [""]
 
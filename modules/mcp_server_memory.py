@@ -3,15 +3,24 @@ from typing import List, Optional, Dict, Any
 from datetime import datetime
 import yaml
 from memory import MemoryManager  # Import MemoryManager to use its path structure
-import json
+import asyncio
 import os
+import re
 import sys
 import signal
+import threading
 from pathlib import Path
+from typing import Iterator
+try:
+    import ijson  # Optional: stream session files item by item instead of loading each whole
+except ImportError:
+    ijson = None
 # Add parent directory to path to import conversation_indexer and models
 sys.path.insert(0, str(Path(__file__).parent.parent))
-from modules.conversation_indexer import search_conversations  # Import semantic search
+from modules.conversation_indexer import asearch_conversation_hits, get_indexer, set_read_only  # Import semantic search
+set_read_only()  # Only the agent writes the index files; this server may be killed at any time
 from models import SearchInput, AnswerFromHistoryInput, AnswerFromHistoryOutput  # Use models from models.py for consistency
+from modules.tools import loads_json  # orjson when installed
 
 BASE_MEMORY_DIR = "memory"
 
@@ -19,6 +28,7 @@ BASE_MEMORY_DIR = "memory"
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = os.path.dirname(SCRIPT_DIR)  # Go up one level from modules to S9
 CONFIG_PATH = os.path.join(ROOT_DIR, "config", "profiles.yaml")
+MEMORY_ROOT = os.path.join(ROOT_DIR, "memory")  # Session files live under MEMORY_ROOT/YYYY/MM/DD
 
 # Load config
 try:
@@ -32,6 +42,55 @@ except Exception as e:
 
 mcp = FastMCP("memory-service")
 
+# Stored final answers that are error markers rather than real answers
+ERROR_PATTERNS = [
+    "[max steps reached]",
+    "[result blocked",
+    "[execution failed]",
+    "[sandbox error:",
+    "[error",
+    "[failed",
+    "[blocked",
+]
+ERROR_RE = re.compile("|".join(map(re.escape, ERROR_PATTERNS)), re.IGNORECASE)
+# A fully bracketed answer mentioning any of these words is an error marker too
+BRACKET_ERR_RE = re.compile(r"error|failed|blocked|max|steps", re.IGNORECASE)
+
+def _is_error_answer(text: str) -> bool:
+    """True if a stored final answer is an error marker (one regex scan, no per-pattern loop)."""
+    if not text:
+        return False
+    if ERROR_RE.search(text):
+        return True
+    stripped = text.strip()
+    return stripped.startswith("[") and stripped.endswith("]") and BRACKET_ERR_RE.search(stripped) is not None
+
+def _iter_session_file(path: str) -> Iterator[Dict]:
+    """Yield the interactions stored in one session file (a JSON array)."""
+    with open(path, 'rb') as f:
+        if ijson is not None:
+            yield from ijson.items(f, 'item')
+        else:
+            yield from loads_json(f.read())  # bytes straight to the parser, no decode pass
+
+def _subdirs(path: str, depth: int):
+    """Yield the directories exactly depth levels below path (symlinks not followed)."""
+    with os.scandir(path) as entries:
+        dirs = [e.path for e in entries if e.is_dir(follow_symlinks=False)]
+    for d in dirs:
+        if depth == 1:
+            yield d
+        else:
+            yield from _subdirs(d, depth - 1)
+
+def _latest_session_file(day_path: str) -> Optional[str]:
+    """Name of the newest session file in day_path, or None if there is none.
+    
+    Session files are named session-<unix ts>-<uid>.json, so the newest is the max name.
+    """
+    with os.scandir(day_path) as entries:
+        return max((e.name for e in entries if e.name.endswith('.json')), default=None)
+
 class MemoryStore:
     def __init__(self):
         self.memory_dir = BASE_MEMORY_DIR
@@ -44,36 +103,23 @@ class MemoryStore:
         # self.memory_manager = MemoryManager(session_id=session_id, memory_dir=self.memory_dir)
         self.current_session = session_id
 
-    def _list_all_memories(self) -> List[Dict]:
-        """Load all memory files using MemoryManager's date-based structure"""
-        all_memories = []
-        base_path = self.memory_dir  # Use the simple memory_dir path
+    def _list_all_memories(self) -> Iterator[Dict]:
+        """Yield all stored interactions using MemoryManager's date-based structure.
         
-        for year_dir in os.listdir(base_path):
-            year_path = os.path.join(base_path, year_dir)
-            if not os.path.isdir(year_path):
-                continue
-                
-            for month_dir in os.listdir(year_path):
-                month_path = os.path.join(year_path, month_dir)
-                if not os.path.isdir(month_path):
-                    continue
-                    
-                for day_dir in os.listdir(month_path):
-                    day_path = os.path.join(month_path, day_dir)
-                    if not os.path.isdir(day_path):
-                        continue
-                        
-                    for file in os.listdir(day_path):
-                        if file.endswith('.json'):
-                            try:
-                                with open(os.path.join(day_path, file), 'r') as f:
-                                    session_memories = json.load(f)
-                                    all_memories.extend(session_memories)  # Extend instead of append
-                            except Exception as e:
-                                print(f"Failed to load {file}: {e}")
+        A generator, so callers that filter or stop early never hold the whole history;
+        wrap in list() where a list is really needed.
+        """
+        base_path = self.memory_dir  # Use the simple memory_dir path
         
-        return all_memories
+        # scandir: entry types come from the directory listing, no stat() per entry
+        for day_path in _subdirs(base_path, depth=3):  # year/month/day
+            with os.scandir(day_path) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.json'):
+                        try:
+                            yield from _iter_session_file(entry.path)
+                        except Exception as e:
+                            print(f"Failed to load {entry.name}: {e}")
 
     def _get_conversation_flow(self, conversation_id: str = None) -> Dict:
         """Get sequence of interactions in a conversation"""
@@ -88,8 +134,8 @@ class MemoryStore:
         interactions = []
         for file in sorted(os.listdir(session_path)):
             if file.endswith('.json'):
-                with open(os.path.join(session_path, file), 'r') as f:
-                    interactions.append(json.load(f))
+                with open(os.path.join(session_path, file), 'rb') as f:
+                    interactions.append(loads_json(f.read()))
         
         return {
             "conversation_flow": [
@@ -124,93 +170,60 @@ def handle_shutdown(signum, frame):
 async def get_current_conversations(input: Dict) -> Dict[str, Any]:
     """Get current session interactions. Usage: input={"input":{}} result = await mcp.call_tool('get_current_conversations', input)"""
     try:
-        # Use absolute paths
-        memory_root = os.path.join(ROOT_DIR, "memory")  # ROOT_DIR is already defined at top
-        dt = datetime.now()
-        
-        # List all files in today's directory
-        day_path = os.path.join(
-            memory_root,
-            str(dt.year),
-            f"{dt.month:02d}",
-            f"{dt.day:02d}"
-        )
+        # Today's directory (absolute path, one strftime)
+        day_path = os.path.join(MEMORY_ROOT, datetime.now().strftime(f"%Y{os.sep}%m{os.sep}%d"))
         
-        if not os.path.exists(day_path):
-            return {"error": "No sessions found for today"}
-            
-        # Get most recent session file
-        session_files = [f for f in os.listdir(day_path) if f.endswith('.json')]
-        if not session_files:
-            return {"error": "No session files found"}
-            
-        latest_file = sorted(session_files)[-1]  # Get most recent
-        file_path = os.path.join(day_path, latest_file)
-        
-        # Read and return contents
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-            
-        return {"result": {
-                    "session_id": latest_file.replace(".json", ""),
-                    "interactions": [
-                        item for item in data 
-                        if item.get("type") != "run_metadata"
-                    ]
-                }}
+        # Directory scan and file parse run in a worker thread, off the event loop
+        return await asyncio.to_thread(_read_latest_session, day_path)
     except Exception as e:
         print(f"[memory] Error: {str(e)}")  # Debug print
         return {"error": str(e)}
 
+def _read_latest_session(day_path: str) -> Dict[str, Any]:
+    """Blocking part of get_current_conversations: find and read the newest session file."""
+    if not os.path.exists(day_path):
+        return {"error": "No sessions found for today"}
+        
+    # Get most recent session file (one pass, no sort)
+    latest_file = _latest_session_file(day_path)
+    if latest_file is None:
+        return {"error": "No session files found"}
+        
+    file_path = os.path.join(day_path, latest_file)
+    
+    # Read and return contents, dropping run metadata as the file is parsed
+    return {"result": {
+                "session_id": latest_file.replace(".json", ""),
+                "interactions": [
+                    item for item in _iter_session_file(file_path)
+                    if item.get("type") != "run_metadata"
+                ]
+            }}
+
 @mcp.tool()
 async def search_historical_conversations(input: SearchInput) -> Dict[str, Any]:
     """Search historical conversations using semantic similarity. Usage: input={"input": {"query": "user's name"}} result = await mcp.call_tool('search_historical_conversations', input)"""
     try:
         # Use semantic search from conversation_indexer
-        results = search_conversations(input.query, top_k=5)
+        results = await asearch_conversation_hits(input.query, top_k=5)
         
         if not results:
             return {"result": []}
         
-        # Error patterns to filter out
-        error_patterns = [
-            "[max steps reached]",
-            "[result blocked",
-            "[execution failed]",
-            "[sandbox error:",
-            "[error",
-            "[failed",
-            "[blocked",
-        ]
-        
         # Format results for LLM consumption, filtering out error messages
         formatted_results = []
         for r in results:
-            final_answer = r.get("final_answer", "")
-            
-            # Check if final_answer is an error message
-            is_error = False
-            if final_answer:
-                final_answer_lower = final_answer.lower()
-                for pattern in error_patterns:
-                    if pattern in final_answer_lower:
-                        is_error = True
-                        break
-                    
-                    # Also check if it's just brackets with error-like content
-                    if final_answer.strip().startswith("[") and final_answer.strip().endswith("]"):
-                        if any(word in final_answer_lower for word in ["error", "failed", "blocked", "max", "steps"]):
-                            is_error = True
+            final_answer = r.meta.get("final_answer", "")
             
             # Skip conversations with error messages as final answers
-            if is_error:
+            if _is_error_answer(final_answer):
                 continue
             
             formatted_results.append({
-                "user_query": r.get("user_query", ""),
+                "user_query": r.meta.get("user_query", ""),
                 "final_answer": final_answer,
-                "timestamp": r.get("timestamp", ""),
-                "similarity_distance": r.get("similarity_distance", float('inf'))
+                "timestamp": r.meta.get("timestamp", ""),
+                "similarity_distance": r.distance
             })
         
         return {"result": formatted_results}
@@ -218,6 +231,34 @@ async def search_historical_conversations(input: SearchInput) -> Dict[str, Any]:
         print(f"[memory] Error in search_historical_conversations: {e}")
         return {"result": [], "error": str(e)}
 
+# Default cap on historical context characters put into the prompt
+# (override per model with "max_context_chars" in models.json)
+MAX_CONTEXT_CHARS = 16000
+
+# answer_from_history prompts; only the query and context are filled in per call
+PROMPT_WITH_CTX = """You are a helpful AI assistant. Answer the user's question based on the provided historical conversation context.
+
+User's current question: "{query}"
+
+Historical conversation context:
+{context}
+
+Your task:
+1. Analyze the historical conversations above to extract relevant information.
+2. If the user's question asks for a comparison, analysis, or synthesis of information from multiple conversations, create a comprehensive answer by combining information from the historical context.
+3. If the question can be answered (even partially) using information from the historical context, provide a clear, detailed answer.
+4. Only respond with "I don't have that information" if the historical context contains NO relevant information at all about the topic.
+
+Important: For comparison queries (e.g., "compare X and Y"), if information about both X and Y exists in the historical context, you MUST create a comparison even if a direct comparison wasn't explicitly stated in previous conversations.
+
+Respond with FINAL_ANSWER: [your comprehensive answer based on the historical context]"""
+
+PROMPT_NO_CTX = """You are a helpful AI assistant. The user asked: "{query}"
+
+No relevant historical conversations were found. Please provide a helpful response based on your general knowledge.
+
+Respond with FINAL_ANSWER: [your answer]"""
+
 @mcp.tool()
 async def answer_from_history(input: AnswerFromHistoryInput) -> AnswerFromHistoryOutput:
     """
@@ -227,53 +268,41 @@ async def answer_from_history(input: AnswerFromHistoryInput) -> AnswerFromHistor
     result = await mcp.call_tool('answer_from_history', input)
     """
     try:
-        from modules.model_manager import ModelManager
+        from modules.model_manager import get_model_manager
+        model = get_model_manager()
         
         # Step 1: Search historical conversations if context not provided
         historical_context = input.historical_context
         if not historical_context:
-            results = search_conversations(input.query, top_k=5)
+            results = await asearch_conversation_hits(input.query, top_k=5)
             
             if results:
-                # Format historical context
+                # Format historical context, stopping at the character budget
+                max_chars = model.model_info.get("max_context_chars", MAX_CONTEXT_CHARS)
                 context_items = []
+                total_len = 0
                 for r in results:
-                    final_answer = r.get("final_answer", "")
+                    final_answer = r.meta.get("final_answer", "")
                     # Skip error messages
-                    if final_answer and any(err in final_answer.lower() for err in ["[max steps reached]", "[result blocked", "[error"]):
+                    if _is_error_answer(final_answer):
                         continue
-                    context_items.append(
-                        f"Previous Q: {r.get('user_query', '')}\n"
+                    item = (
+                        f"Previous Q: {r.meta.get('user_query', '')}\n"
                         f"Previous A: {final_answer}"
                     )
-                historical_context = "\n\n".join(context_items[:5])  # Top 5 most relevant
+                    if context_items and total_len + len(item) > max_chars:
+                        break  # The most relevant conversation is always kept
+                    context_items.append(item)
+                    total_len += len(item) + 2  # + separator
+                    if len(context_items) == 5:  # Top 5 most relevant
+                        break
+                historical_context = "\n\n".join(context_items)
         
         # Step 2: Use LLM to generate FINAL_ANSWER from historical context
-        model = ModelManager()
-        
         if historical_context:
-            prompt = f"""You are a helpful AI assistant. Answer the user's question based on the provided historical conversation context.
-
-User's current question: "{input.query}"
-
-Historical conversation context:
-{historical_context}
-
-Your task:
-1. Analyze the historical conversations above to extract relevant information.
-2. If the user's question asks for a comparison, analysis, or synthesis of information from multiple conversations, create a comprehensive answer by combining information from the historical context.
-3. If the question can be answered (even partially) using information from the historical context, provide a clear, detailed answer.
-4. Only respond with "I don't have that information" if the historical context contains NO relevant information at all about the topic.
-
-Important: For comparison queries (e.g., "compare X and Y"), if information about both X and Y exists in the historical context, you MUST create a comparison even if a direct comparison wasn't explicitly stated in previous conversations.
-
-Respond with FINAL_ANSWER: [your comprehensive answer based on the historical context]"""
+            prompt = PROMPT_WITH_CTX.format(query=input.query, context=historical_context)
         else:
-            prompt = f"""You are a helpful AI assistant. The user asked: "{input.query}"
-
-No relevant historical conversations were found. Please provide a helpful response based on your general knowledge.
-
-Respond with FINAL_ANSWER: [your answer]"""
+            prompt = PROMPT_NO_CTX.format(query=input.query)
         
         llm_response = await model.generate_text(prompt)
         llm_response = llm_response.strip()
@@ -295,6 +324,11 @@ if __name__ == "__main__":
     signal.signal(signal.SIGINT, handle_shutdown)
     signal.signal(signal.SIGTERM, handle_shutdown)
     
+    # This server is spawned per tool call: load the FAISS index while the MCP handshake runs
+    # (get_indexer() is lock-guarded, so the tool call just waits for this load to finish;
+    # the load is read-only, so the daemon thread dying with the process can't tear a file)
+    threading.Thread(target=get_indexer, daemon=True).start()
+    
     try:
         if len(sys.argv) > 1 and sys.argv[1] == "dev":
             mcp.run()
@@ -37,6 +37,7 @@ class MemoryManager:
         self.memory_dir = memory_dir
         self.memory_path = os.path.join('memory', session_id.split('-')[0], session_id.split('-')[1], session_id.split('-')[2], f'session-{session_id}.json')
         self.items: List[MemoryItem] = []
+        self.tool_outputs: List[MemoryItem] = []  # Subset of items with type "tool_output"
 
         if not os.path.exists(self.memory_dir):
             os.makedirs(self.memory_dir)
@@ -50,6 +51,7 @@ class MemoryManager:
                 self.items = [MemoryItem(**item) for item in raw]
         else:
             self.items = []
+        self.tool_outputs = [item for item in self.items if item.type == "tool_output"]
 
     def save(self):
         # Before opening the file for writing
@@ -60,6 +62,8 @@ class MemoryManager:
 
     def add(self, item: MemoryItem):
         self.items.append(item)
+        if item.type == "tool_output":
+            self.tool_outputs.append(item)
         self.save()
 
     def add_tool_call(
@@ -104,8 +108,8 @@ class MemoryManager:
         tool_successes = []
 
         # Search from newest to oldest
-        for item in reversed(self.items):
-            if item.type == "tool_output" and item.success:
+        for item in reversed(self.tool_outputs):
+            if item.success:
                 if item.tool_name and item.tool_name not in tool_successes:
                     tool_successes.append(item.tool_name)
             if len(tool_successes) >= limit:
@@ -131,3 +135,9 @@ class MemoryManager:
         Return all memory items for current session.
         """
         return self.items
+
+    def get_tool_outputs(self) -> List[MemoryItem]:
+        """
+        Return the tool_output items for current session, in insertion order.
+        """
+        return self.tool_outputs
@@ -1,12 +1,18 @@
 import os
 import json
-import yaml
-import requests
+import asyncio
+import threading
+import weakref
+from functools import lru_cache
+from typing import Optional
+import httpx
 from pathlib import Path
 from google import genai
-from openai import OpenAI
+from openai import AsyncOpenAI
 from openai import APIError, AuthenticationError
 from dotenv import load_dotenv
+from core.config import load_profile
+from modules.tools import LRUCache
 
 load_dotenv()
 
@@ -14,15 +20,41 @@ ROOT = Path(__file__).parent.parent
 MODELS_JSON = ROOT / "config" / "models.json"
 PROFILE_YAML = ROOT / "config" / "profiles.yaml"
 
+
+@lru_cache(maxsize=4)
+def _load_models_config(path: str, mtime: float) -> dict:
+    return json.loads(Path(path).read_text())
+
+
+# Completions kept by the exact-prompt response cache (llm.cache_responses in profiles.yaml)
+LLM_RESPONSE_CACHE_SIZE = 1024
+
+# Keep-alive connections to Ollama (no timeout, as generation can take arbitrarily long)
+_OLLAMA_LIMITS = httpx.Limits(max_keepalive_connections=8)
+
+
+def load_models_config(path: Path = MODELS_JSON) -> dict:
+    """Load models.json, re-parsing only when the file's mtime changes (shared, read-only)."""
+    path = str(path)
+    return _load_models_config(path, os.path.getmtime(path))
+
+
 class ModelManager:
     def __init__(self):
-        self.config = json.loads(MODELS_JSON.read_text())
-        self.profile = yaml.safe_load(PROFILE_YAML.read_text())
+        self.config = load_models_config()
+        self.profile = load_profile(PROFILE_YAML)
 
         self.text_model_key = self.profile["llm"]["text_generation"]
         self.model_info = self.config["models"][self.text_model_key]
         self.model_type = self.model_info["type"]
 
+        # Exact-prompt response cache: opt in per profile, opt a model out with "no_cache"
+        self.cache_responses = bool(self.profile["llm"].get("cache_responses", False)) and not self.model_info.get("no_cache", False)
+        self._response_cache = LRUCache(LLM_RESPONSE_CACHE_SIZE)
+
+        # Ollama: one async client per event loop
+        self._async_http: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
         # ✅ Gemini initialization (your style)
         if self.model_type == "gemini":
             api_key = os.getenv("GEMINI_API_KEY")
@@ -38,24 +70,62 @@ class ModelManager:
                     f"Please set it in your .env file or environment. "
                     f"Get your key at: https://platform.openai.com/account/api-keys"
                 )
-            self.client = OpenAI(api_key=api_key)
+            self.async_client = AsyncOpenAI(api_key=api_key)
 
-    async def generate_text(self, prompt: str) -> str:
+    async def generate_text(self, prompt: str, system_prompt: Optional[str] = None, cache: bool = True) -> str:
+        """
+        Generate a completion for prompt.
+        
+        Args:
+            prompt: User prompt (the per-call, dynamic part)
+            system_prompt: Optional static instructions sent as a separate system message;
+                keeping them byte-identical across calls lets providers reuse their prompt-prefix cache
+            cache: False for callers that cache the result themselves, so the same prompt
+                isn't held in two caches
+        """
+        if not (self.cache_responses and cache):
+            return await self._generate(prompt, system_prompt)
+        
+        # Keyed by model too, so switching text_generation never serves another model's answer
+        key = (self.text_model_key, system_prompt, prompt)
+        cached = self._response_cache.get(key)
+        if cached is not None:
+            return cached
+        response = await self._generate(prompt, system_prompt)
+        self._response_cache.put(key, response)
+        return response
+
+    async def _generate(self, prompt: str, system_prompt: Optional[str] = None) -> str:
+        # Native async clients: the event loop stays free while the provider works
         if self.model_type == "gemini":
-            return self._gemini_generate(prompt)
+            return await self._gemini_generate(prompt, system_prompt)
 
         elif self.model_type == "ollama":
-            return self._ollama_generate(prompt)
+            return await self._ollama_generate(prompt, system_prompt)
         
         elif self.model_type == "openai":
-            return self._openai_generate(prompt)
+            return await self._openai_generate(prompt, system_prompt)
 
         raise NotImplementedError(f"Unsupported model type: {self.model_type}")
 
-    def _gemini_generate(self, prompt: str) -> str:
-        response = self.client.models.generate_content(
+    def _async_http_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._async_http.get(loop)
+        if client is None or client.is_closed:
+            client = self._async_http[loop] = httpx.AsyncClient(timeout=None, limits=_OLLAMA_LIMITS)
+        return client
+
+    async def aclose_http_clients(self):
+        """Close the current event loop's Ollama client (call before the loop shuts down)."""
+        client = self._async_http.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    async def _gemini_generate(self, prompt: str, system_prompt: Optional[str] = None) -> str:
+        response = await self.client.aio.models.generate_content(
             model=self.model_info["model"],
-            contents=prompt
+            contents=prompt,
+            config={"system_instruction": system_prompt} if system_prompt else None
         )
 
         # ✅ Safely extract response text
@@ -67,24 +137,26 @@ class ModelManager:
             except Exception:
                 return str(response)
 
-    def _ollama_generate(self, prompt: str) -> str:
-        response = requests.post(
-            self.model_info["url"]["generate"],
-            json={"model": self.model_info["model"], "prompt": prompt, "stream": False}
-        )
+    async def _ollama_generate(self, prompt: str, system_prompt: Optional[str] = None) -> str:
+        payload = {"model": self.model_info["model"], "prompt": prompt, "stream": False}
+        if system_prompt:
+            payload["system"] = system_prompt
+        response = await self._async_http_client().post(self.model_info["url"]["generate"], json=payload)
         response.raise_for_status()
         return response.json()["response"].strip()
 
-    def _openai_generate(self, prompt: str) -> str:
+    async def _openai_generate(self, prompt: str, system_prompt: Optional[str] = None) -> str:
         """Generate text using OpenAI API."""
         temperature = self.model_info.get("temperature", 0.7)
         
+        # System message first: OpenAI caches identical prompt prefixes
+        messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+        messages.append({"role": "user", "content": prompt})
+        
         try:
-            response = self.client.chat.completions.create(
+            response = await self.async_client.chat.completions.create(
                 model=self.model_info["model"],
-                messages=[
-                    {"role": "user", "content": prompt}
-                ],
+                messages=messages,
                 temperature=temperature
             )
             
@@ -124,3 +196,17 @@ class ModelManager:
             raise ValueError(
                 f"❌ OpenAI Request Error: {str(e)}"
             ) from e
+
+
+_model_manager: Optional[ModelManager] = None
+_model_manager_lock = threading.Lock()
+
+
+def get_model_manager() -> ModelManager:
+    """Get or create the shared ModelManager (one provider client per process)."""
+    global _model_manager
+    if _model_manager is None:
+        with _model_manager_lock:
+            if _model_manager is None:
+                _model_manager = ModelManager()
+    return _model_manager
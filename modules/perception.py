@@ -2,11 +2,10 @@
 
 from typing import List, Optional
 from pydantic import BaseModel
-from modules.model_manager import ModelManager
-from modules.tools import load_prompt, extract_json_block
+from modules.model_manager import get_model_manager
+from modules.tools import LRUCache, load_prompt, extract_json_block, loads_json
 from core.context import AgentContext
-
-import json
+from core.config import load_profile
 
 
 # Optional logging fallback
@@ -18,11 +17,17 @@ except ImportError:
         now = datetime.datetime.now().strftime("%H:%M:%S")
         print(f"[{now}] [{stage}] {msg}")
 
-model = ModelManager()
+model = get_model_manager()
 
 
 prompt_path = "prompts/perception_prompt.txt"
 
+# Raw LLM output per full perception prompt (template + servers + input + context), so
+# a resubmitted query skips the LLM call. Off unless perception.cache_results is set; while
+# on, the call bypasses llm.cache_responses so the prompt isn't cached twice.
+PERCEPTION_CACHE_SIZE = 256
+_perception_cache = LRUCache(PERCEPTION_CACHE_SIZE)
+
 class PerceptionResult(BaseModel):
     intent: str
     entities: List[str] = []
@@ -30,6 +35,23 @@ class PerceptionResult(BaseModel):
     tags: List[str] = []
     selected_servers: List[str] = []  # 🆕 NEW field
 
+# (descriptions dict, formatted text) for the last server list seen. The agent passes the
+# same read-only dict from get_mcp_servers() on every call, so this is rebuilt only when
+# profiles.yaml changes.
+_servers_text_cache: tuple = (None, "")
+
+def _servers_text(mcp_server_descriptions: dict) -> str:
+    global _servers_text_cache
+    cached_for, text = _servers_text_cache
+    if cached_for is mcp_server_descriptions:
+        return text
+    text = "\n".join(
+        f"- {server_id}: {server_info.get('description', 'No description available')}"
+        for server_id, server_info in mcp_server_descriptions.items()
+    )
+    _servers_text_cache = (mcp_server_descriptions, text)
+    return text
+
 async def extract_perception(user_input: str, mcp_server_descriptions: dict, historical_context: Optional[str] = None) -> PerceptionResult:
     """
     Extracts perception details and selects relevant MCP servers based on the user query.
@@ -40,12 +62,7 @@ async def extract_perception(user_input: str, mcp_server_descriptions: dict, his
         historical_context: Optional historical conversation context to inform tool selection
     """
 
-    server_list = []
-    for server_id, server_info in mcp_server_descriptions.items():
-        description = server_info.get("description", "No description available")
-        server_list.append(f"- {server_id}: {description}")
-
-    servers_text = "\n".join(server_list)
+    servers_text = _servers_text(mcp_server_descriptions)
 
     prompt_template = load_prompt(prompt_path)
     
@@ -65,21 +82,29 @@ Use this context to inform your tool selection and search strategy."""
     )
     
 
+    use_cache = load_profile().get("perception", {}).get("cache_results", False)
     try:
-        raw = await model.generate_text(prompt)
-        raw = raw.strip()
-        log("perception", f"Raw output: {raw}")
+        raw = _perception_cache.get(prompt) if use_cache else None
+        if raw is not None:
+            log("perception", "♻️ Reusing cached perception for an identical prompt")
+        else:
+            raw = await model.generate_text(prompt, cache=not use_cache)  # One cache per prompt
+            raw = raw.strip()
+            log("perception", f"Raw output: {raw}")
 
         # Try parsing into PerceptionResult
         json_block = extract_json_block(raw)
-        result = json.loads(json_block)
+        result = loads_json(json_block)
 
         # If selected_servers missing, fallback
         if "selected_servers" not in result:
             result["selected_servers"] = list(mcp_server_descriptions.keys())
         print("result", result)
 
-        return PerceptionResult(**result)
+        perception = PerceptionResult(**result)
+        if use_cache:  # Only outputs that parsed are cached
+            _perception_cache.put(prompt, raw)
+        return perception
 
     except Exception as e:
         log("perception", f"⚠️ Perception failed: {e}")
@@ -1,8 +1,59 @@
 # modules/tools.py
 
-from typing import List, Dict, Optional, Any
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Dict, Optional, Any, Tuple, Union
+import json
+import os
 import re
 
+try:
+    import orjson  # Optional: several times faster decoding of large tool payloads
+except ImportError:
+    orjson = None
+
+# Optional: exact token counts for prompt budgets (falls back to a chars-per-token estimate)
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _ENCODING = None
+
+CHARS_PER_TOKEN = 4  # Rough average for English text, used without tiktoken
+_SCAN_CHUNK = 16384  # Characters tokenized per pass when scanning for the budget
+
+class LRUCache:
+    """
+    Bounded in-process cache that evicts the least recently used entry.
+    
+    Not thread-safe: each user is confined to one thread (the event loop) or holds its own lock.
+    """
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+    
+    def get(self, key: Any) -> Any:
+        """Cached value for key (marking it recently used), or None on a miss."""
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+    
+    def put(self, key: Any, value: Any):
+        """Store value under key, evicting the oldest entry once maxsize is exceeded."""
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def __len__(self) -> int:
+        return len(self._data)
+
+def loads_json(data: Union[str, bytes]) -> Any:
+    """json.loads, via orjson when installed (MCP tool results arrive as JSON text)."""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
 def extract_json_block(text: str) -> str:
     match = re.search(r"```json\n(.*?)```", text, re.DOTALL)
     if match:
@@ -39,6 +90,32 @@ def summarize_tools(tools: List[Any]) -> str:
     )
 
 
+def head_by_tokens(text: str, max_tokens: int) -> Tuple[str, int]:
+    """
+    Return the longest prefix of text that fits in max_tokens.
+    
+    Text is tokenized chunk by chunk and scanning stops once the budget is reached,
+    so huge tool outputs are never tokenized (or copied) in full.
+    
+    Returns:
+        (prefix, token_count) - prefix is text itself when it already fits
+    """
+    if _ENCODING is None:
+        max_chars = max_tokens * CHARS_PER_TOKEN
+        if len(text) <= max_chars:
+            return text, -(-len(text) // CHARS_PER_TOKEN)
+        return text[:max_chars], max_tokens
+    
+    tokens: List[int] = []
+    for pos in range(0, len(text), _SCAN_CHUNK):
+        tokens.extend(_ENCODING.encode(text[pos:pos + _SCAN_CHUNK], disallowed_special=()))
+        if len(tokens) >= max_tokens:
+            if len(tokens) == max_tokens and pos + _SCAN_CHUNK >= len(text):
+                break  # Exactly fits
+            return _ENCODING.decode(tokens[:max_tokens]), max_tokens
+    return text, len(tokens)
+
+
 def filter_tools_by_hint(tools: List[Any], hint: Optional[str] = None) -> List[Any]:
     """
     If tool_hint is provided (e.g., 'search_documents'),
@@ -67,6 +144,11 @@ def tool_expects_input(self, tool_name: str) -> bool:
 
 
 def load_prompt(path: str) -> str:
+    """Read a prompt template, re-reading the file only when its mtime changes."""
+    return _read_prompt(path, os.path.getmtime(path))
+
+@lru_cache(maxsize=16)
+def _read_prompt(path: str, mtime: float) -> str:
     with open(path, "r", encoding="utf-8") as f:
         content = f.read()
         # Strip the first line if it's "prompt = f""""